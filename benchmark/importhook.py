@@ -0,0 +1,82 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Cold start child for lambda_benchmark.py --importtime.
+
+Kept apart from the benchmark and importing nothing the interpreter has not
+already loaded, so -X importtime reports every module the function imports.
+The benchmark and its stand-ins are loaded between the function's import and
+its first invocation, between marks the parent leaves out.
+
+    python -X importtime -c "import importhook; importhook.coldstart()" LAMBDA_DIR SCENARIO REGIONS FINDINGS ACCOUNTS
+"""
+
+import sys
+
+# Written to stderr where the function's import starts
+IMPORTMARK = "benchmark: cold start"
+
+# Written to stderr around loading the benchmark's stand-ins
+STANDINMARK = "benchmark: stand-in"
+STANDINDONE = "benchmark: stand-in loaded"
+
+
+class PatchOnImport(object):
+    """ Import hook that routes boto3 clients to the local stand-in as soon as
+    the function imports boto3, without importing it any earlier """
+
+    def __init__(self, world=None):
+        self.world = world
+
+    def find_spec(self, name, path, target=None):
+        if name != 'boto3':
+            return None
+        sys.meta_path.remove(self)
+        for finder in sys.meta_path:
+            spec = finder.find_spec(name, path, target) if hasattr(finder, 'find_spec') else None
+            if spec is not None:
+                break
+        else:
+            return None
+        exec_module = spec.loader.exec_module
+        hook = self
+
+        def patched(module):
+            exec_module(module)
+            # The world may be set after the hook is installed
+            module.client = lambda *args, **kwargs: hook.world.client(*args, **kwargs)
+        spec.loader.exec_module = patched
+        return spec
+
+
+def mark(line):
+    sys.stderr.write(line + "\n")
+    sys.stderr.flush()
+
+
+def coldstart(argv=None):
+    """ Import the function, then run one invocation of a benchmark scenario """
+    lambdadir, scenario, regions, findings, accounts = (argv or sys.argv[1:])[:5]
+    hook = PatchOnImport()
+    sys.meta_path.insert(0, hook)
+    sys.path.insert(0, lambdadir)
+    mark(IMPORTMARK)
+    import lambda_function
+    mark(STANDINMARK)
+    import lambda_benchmark as bench
+    world = bench.World(bench.REGIONS[:int(regions)], int(findings), 0, 0, 0, int(accounts))
+    event, context = bench.SCENARIOS[scenario](), bench.Context()
+    hook.world = world
+    mark(STANDINDONE)
+    lambda_function.lambda_handler(event, context)
@@ -0,0 +1,503 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Offline load test for the Ask GuardDuty Lambda function.
+
+Replays synthetic Alexa events through lambda_handler against a local
+GuardDuty stand-in with configurable per-call latency, throttling and
+finding volumes, and reports p50/p95/p99 latency and API calls per intent
+for cold and warm invocations.
+
+    python benchmark/lambda_benchmark.py --regions 14 --findings 2000 --latency-ms 80
+
+--account-mode administrator|assumerole spreads findings over --accounts
+member accounts and runs the function with ACCOUNTMODE against a local STS
+stand-in as well.
+
+--importtime instead runs one cold start per intent in a fresh interpreter
+under -X importtime and reports the import cost each intent pays.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import importhook
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lambda")
+
+# Alexa responses must arrive within 8 seconds
+ALEXA_DEADLINE_MS = 8000
+
+REGIONS = ["us-east-1", "us-east-2", "us-west-1", "us-west-2", "ca-central-1", "sa-east-1",
+           "eu-central-1", "eu-west-1", "eu-west-2", "ap-south-1", "ap-northeast-1",
+           "ap-northeast-2", "ap-southeast-1", "ap-southeast-2"]
+
+SEVERITIES = [2.0, 2.5, 5.0, 5.3, 6.0, 7.0, 8.0, 8.5]
+
+TYPES = ["Recon:EC2/PortProbeUnprotectedPort", "UnauthorizedAccess:EC2/SSHBruteForce",
+         "Recon:IAMUser/MaliciousIPCaller", "CryptoCurrency:EC2/BitcoinTool.B!DNS",
+         "Trojan:EC2/DNSDataExfiltration", "Backdoor:EC2/Spambot"]
+
+
+class ClientError(Exception):
+    """ Error shaped like botocore's ClientError """
+    def __init__(self, code, operation):
+        Exception.__init__(self, "An error occurred (" + code + ") when calling the " + operation + " operation")
+        self.response = {'Error': {'Code': code, 'Message': code}}
+
+
+class LocalGuardDuty(object):
+    """ Local stand-in for a regional GuardDuty client. Without assumed role
+    credentials it is the administrator account's client and sees member
+    findings too. """
+
+    def __init__(self, region_name, findings, world, members=()):
+        self.region_name = region_name
+        self.findings = findings
+        self.byid = dict((f['Id'], f) for f in findings)
+        self.world = world
+        self.members = members
+
+    def call(self, operation):
+        self.world.record(self.region_name, operation)
+        self.world.deny(operation)
+        delay = self.world.latency + random.uniform(0, self.world.jitter)
+        time.sleep(delay)
+        if random.random() < self.world.throttle:
+            raise ClientError("TooManyRequestsException", operation)
+
+    def matching(self, criteria):
+        criterion = (criteria or {}).get('Criterion', {})
+        minsev = criterion.get('severity', {}).get('Gte', 0)
+        since = criterion.get('updatedAt', {}).get('Gt')
+        accounts = criterion.get('accountId', {}).get('Eq')
+        result = []
+        for f in self.findings:
+            if f['Severity'] < minsev:
+                continue
+            if since is not None and f['UpdatedAtMillis'] <= since:
+                continue
+            if accounts and f['AccountId'] not in accounts:
+                continue
+            result.append(f)
+        return result
+
+    def list_detectors(self, **kwargs):
+        self.call('ListDetectors')
+        if self.region_name in self.world.disabled:
+            return {'DetectorIds': []}
+        return {'DetectorIds': ["detector-" + self.region_name]}
+
+    def get_findings_statistics(self, DetectorId, FindingCriteria=None, FindingStatisticTypes=None, GroupBy=None,
+                                OrderBy='DESC', MaxResults=25, **kwargs):
+        self.call('GetFindingsStatistics')
+        findings = self.matching(FindingCriteria)
+        statistics = {'CountBySeverity': dict(Counter(str(f['Severity']) for f in findings))}
+        if GroupBy == 'FINDING_TYPE':
+            types = Counter(f['Type'] for f in findings).most_common()
+            if OrderBy == 'ASC':
+                types.reverse()
+            statistics['GroupedByFindingType'] = [{'FindingType': t, 'TotalFindings': n}
+                                                  for t, n in types[:MaxResults]]
+        elif GroupBy is not None:
+            raise ClientError("BadRequestException", "GetFindingsStatistics")
+        return {'FindingStatistics': statistics}
+
+    def list_findings(self, DetectorId, FindingCriteria=None, SortCriteria=None, MaxResults=50, NextToken=None, **kwargs):
+        self.call('ListFindings')
+        findings = self.matching(FindingCriteria)
+        if SortCriteria:
+            attribute = {'severity': 'Severity', 'updatedAt': 'UpdatedAtMillis'}[SortCriteria['AttributeName']]
+            findings.sort(key=lambda f: f[attribute], reverse=SortCriteria.get('OrderBy') == 'DESC')
+        start = int(NextToken or 0)
+        page = findings[start:start + MaxResults]
+        response = {'FindingIds': [f['Id'] for f in page]}
+        if start + MaxResults < len(findings):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def get_findings(self, DetectorId, FindingIds, SortCriteria=None, **kwargs):
+        self.call('GetFindings')
+        if len(FindingIds) > 50:
+            raise ClientError("BadRequestException", "GetFindings")
+        findings = [dict(self.byid[i]) for i in FindingIds]
+        for f in findings:
+            del f['UpdatedAtMillis']
+        return {'Findings': findings}
+
+    def list_members(self, DetectorId, **kwargs):
+        self.call('ListMembers')
+        return {'Members': [{'AccountId': a, 'RelationshipStatus': "Enabled"} for a in self.members]}
+
+
+class LocalSTS(object):
+    """ Local stand-in for an STS client. Roles can be assumed in any
+    account the world knows. """
+
+    def __init__(self, region_name, world):
+        self.region_name = region_name
+        self.world = world
+
+    def get_caller_identity(self, **kwargs):
+        self.world.record(self.region_name, 'GetCallerIdentity')
+        self.world.deny('GetCallerIdentity')
+        account = self.world.accounts[0]
+        return {'Account': account, 'Arn': "arn:aws:sts::" + account + ":assumed-role/AskGuardDuty/benchmark"}
+
+    def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+        self.world.record(self.region_name, 'AssumeRole')
+        self.world.deny('AssumeRole')
+        account = RoleArn.split(":")[4]
+        if account not in self.world.accounts:
+            raise ClientError("AccessDenied", "AssumeRole")
+        return {'Credentials': {
+            'AccessKeyId': "ASIA" + account,
+            'SecretAccessKey': "benchmark",
+            'SessionToken': RoleSessionName,
+            'Expiration': datetime.now(timezone.utc) + timedelta(hours=1)
+        }}
+
+
+class World(object):
+    """ Local GuardDuty accounts, regions and API call accounting. The first
+    account is the administrator, the rest are its members. """
+
+    def __init__(self, regions, findings, latency_ms, jitter_ms, throttle, accounts=1):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.throttle = throttle
+        self.calls = Counter()
+        self.regioncalls = Counter()
+        self.clients = 0
+        self.lock = threading.Lock()
+        self.accounts = ["111122223333"] + ["4444555566%02d" % i for i in range(1, accounts)]
+        # Regions where GuardDuty is not enabled
+        self.disabled = set()
+        # Operations the caller is not allowed to call
+        self.denied = set()
+        self.findings = dict((r, makefindings(r, findings, self.accounts)) for r in regions)
+
+    def record(self, region_name, operation):
+        with self.lock:
+            self.calls[operation] += 1
+            self.regioncalls[(region_name, operation)] += 1
+
+    def deny(self, operation):
+        if operation in self.denied:
+            raise ClientError("AccessDeniedException", operation)
+
+    def client(self, service, region_name=None, aws_access_key_id=None, **kwargs):
+        with self.lock:
+            self.clients += 1
+        if service == 'sts':
+            return LocalSTS(region_name, self)
+        if service != 'guardduty':
+            raise ValueError("No local stand-in for " + service)
+        findings = self.findings.get(region_name, [])
+        if aws_access_key_id:
+            # Assumed role credentials from LocalSTS carry the account
+            account = aws_access_key_id[len("ASIA"):]
+            return LocalGuardDuty(region_name, [f for f in findings if f['AccountId'] == account], self)
+        return LocalGuardDuty(region_name, findings, self, self.accounts[1:])
+
+    def reset(self):
+        with self.lock:
+            self.calls = Counter()
+            self.regioncalls = Counter()
+            self.clients = 0
+
+
+def makefindings(region_name, count, accounts=("111122223333",)):
+    findings = []
+    now = int(time.time() * 1000)
+    for i in range(count):
+        updated = now - random.randint(0, 30 * 24 * 3600 * 1000)
+        findings.append({
+            'Id': region_name + "-" + str(i),
+            'Region': region_name,
+            'AccountId': accounts[i % len(accounts)],
+            'Severity': random.choice(SEVERITIES),
+            'Type': random.choice(TYPES),
+            'Title': "Unprotected port on EC2 instance i-%08x is being probed from 198.51.100.%d" % (i, i % 250),
+            'Service': {'Count': random.randint(1, 40)},
+            'Resource': {'ResourceType': "Instance", 'InstanceDetails': {'InstanceId': "i-%08x" % (i % 97)}},
+            'UpdatedAt': time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(updated / 1000.0)),
+            'UpdatedAtMillis': updated
+        })
+    return findings
+
+
+class Context(object):
+    """ Minimal Lambda context """
+
+    def __init__(self, timeout_ms=ALEXA_DEADLINE_MS):
+        self.deadline = time.time() + timeout_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - time.time()) * 1000)
+
+
+def event(intent=None, slots=None, request_type="IntentRequest", new=False):
+    request = {'type': request_type, 'requestId': "EdwRequestId.benchmark", 'locale': "en-US"}
+    if intent:
+        request['intent'] = {'name': intent, 'slots': slots or {}}
+    return {
+        'session': {
+            'new': new,
+            'sessionId': "SessionId.benchmark",
+            'application': {'applicationId': "amzn1.ask.skill.benchmark"},
+            'attributes': {},
+            'user': {'userId': "amzn1.ask.account.benchmark"}
+        },
+        'request': request,
+        'version': "1.0"
+    }
+
+
+SCENARIOS = {
+    'LaunchRequest': lambda: event(request_type="LaunchRequest", new=True),
+    'Help': lambda: event("AMAZON.HelpIntent"),
+    'SessionEnded': lambda: event(request_type="SessionEndedRequest"),
+    'FlashBriefing': lambda: event("FlashBriefing"),
+    'ListStats': lambda: event("ListStats", {'selectedRegion': {'name': "selectedRegion", 'value': "Virginia"}}),
+    'ListFindings': lambda: event("ListFindings", {'selectedRegion': {'name': "selectedRegion", 'value': "Oregon"},
+                                                   'SevName': {'name': "SevName", 'value': "high"}}),
+}
+
+
+def loadfunction(world, env):
+    """ Import a fresh copy of the function, as on a cold start """
+    os.environ.update(env)
+    sys.path.insert(0, LAMBDA_DIR)
+    sys.modules.pop('lambda_function', None)
+    start = time.time()
+    module = importlib.import_module('lambda_function')
+    import_ms = (time.time() - start) * 1000
+    sys.path.remove(LAMBDA_DIR)
+    # Route every boto3 client the function builds to the local stand-in
+    import boto3
+    boto3.client = world.client
+    return module, import_ms
+
+
+# Lines written by -X importtime: self us, cumulative us, indented module name
+IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+# Starts the cold start child from importhook, which imports nothing the
+# function would, rather than from this module
+COLDSTART = "import importhook; importhook.coldstart()"
+
+
+def coldimports(args, env, scenario):
+    """ Modules one cold start of scenario imports, as (name, depth, cumulative
+    us) from -X importtime, leaving out the benchmark's own stand-ins """
+    world = World([], 0, 0, 0, 0, args.accounts)
+    child = [sys.executable, "-X", "importtime", "-c", COLDSTART, os.path.abspath(LAMBDA_DIR), scenario,
+             str(args.regions), str(min(args.findings, 50)), str(args.accounts)]
+    output = subprocess.run(child, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=dict(os.environ, **dict(env, **accountenv(args, world)))).stderr
+    output = output.split(importhook.IMPORTMARK, 1)[-1]
+    function, _, rest = output.partition(importhook.STANDINMARK)
+    modules = []
+    for line in (function + rest.partition(importhook.STANDINDONE)[2]).splitlines():
+        match = IMPORTTIME.match(line)
+        if match:
+            modules.append((match.group(4), len(match.group(3)), int(match.group(2))))
+    return modules
+
+
+def importtimes(args, env):
+    """ Import cost of a cold start per intent, from -X importtime """
+    results = {}
+    for scenario in args.intents:
+        modules = coldimports(args, env, scenario)
+        # Only top level imports, their cumulative time covers the rest
+        total = sum(us for name, depth, us in modules if depth == 1)
+        names = [name for name, depth, us in modules]
+        results[scenario] = {'importMs': round(total / 1000.0, 1), 'modules': len(names),
+                             'boto3': 'boto3' in names}
+    return results
+
+
+def reportimports(results):
+    header = "%-14s %10s %8s %6s" % ("intent", "import ms", "modules", "boto3")
+    print(header)
+    print("-" * len(header))
+    for scenario, r in results.items():
+        print("%-14s %10.1f %8d %6s" % (scenario, r['importMs'], r['modules'], "yes" if r['boto3'] else "no"))
+
+
+def invoke(module, world, scenario):
+    world.reset()
+    error = 0
+    start = time.time()
+    try:
+        module.lambda_handler(SCENARIOS[scenario](), Context())
+    except Exception:
+        error = 1
+    return (time.time() - start) * 1000, sum(world.calls.values()), world.clients, error
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def summarize(samples):
+    latencies = [s[0] for s in samples]
+    return {
+        'n': len(samples),
+        'p50': round(percentile(latencies, 50), 1),
+        'p95': round(percentile(latencies, 95), 1),
+        'p99': round(percentile(latencies, 99), 1),
+        'max': round(max(latencies), 1),
+        'apiCalls': round(sum(s[1] for s in samples) / float(len(samples)), 2),
+        'clients': round(sum(s[2] for s in samples) / float(len(samples)), 2),
+        'overDeadline': sum(1 for l in latencies if l > ALEXA_DEADLINE_MS),
+        'errors': sum(s[3] for s in samples)
+    }
+
+
+def run(args):
+    regions = REGIONS[:args.regions]
+    world = World(regions, args.findings, args.latency_ms, args.jitter_ms, args.throttle, args.accounts)
+    env = accountenv(args, world)
+    env.update({'MAXRESP': str(args.maxresp), 'FLASHREGIONS': ",".join(regions),
+                'RESPONSECACHETTL': str(args.response_cache_ttl)})
+    results = {}
+    for scenario in args.intents:
+        cold = []
+        warm = []
+        imports = []
+        for _ in range(args.cold):
+            module, import_ms = loadfunction(world, env)
+            imports.append(import_ms)
+            cold.append(invoke(module, world, scenario))
+        module, _ = loadfunction(world, env)
+        invoke(module, world, scenario)
+        for _ in range(args.iterations):
+            warm.append(invoke(module, world, scenario))
+        results[scenario] = {'cold': summarize(cold), 'warm': summarize(warm),
+                             'importMs': round(percentile(imports, 50), 1)}
+    if args.render:
+        module, _ = loadfunction(world, env)
+        results['render'] = renderbenchmark(module, args.render)
+    return results
+
+
+def accountenv(args, world):
+    """ ACCOUNTMODE settings for the function. Administrator mode discovers
+    members with list_members, assumerole mode needs them listed. """
+    env = {'ACCOUNTMODE': args.account_mode, 'MEMBERACCOUNTS': ""}
+    if args.account_mode == "assumerole":
+        env['MEMBERACCOUNTS'] = ",".join(world.accounts)
+    return env
+
+
+def renderbenchmark(module, count, repeat=20):
+    """ Time rendering SSML and card text for count findings """
+    findings = [module.projectfinding(f, "us-east-1") for f in makefindings("us-east-1", count)]
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        speech = module.Speech("<speak>").join([module.describefinding(f) for f in findings]).say("</speak>")
+        module.build_speechlet_response("Benchmark", speech, "<speak>Reprompt</speak>", False)
+        timings.append((time.time() - start) * 1000)
+    return {'findings': count, 'p50': round(percentile(timings, 50), 2), 'max': round(max(timings), 2)}
+
+
+def report(results):
+    header = "%-14s %-5s %6s %9s %9s %9s %9s %9s %8s %6s %6s %9s" % (
+        "intent", "start", "n", "p50 ms", "p95 ms", "p99 ms", "max ms", "api/req", "clients", ">8s", "errors",
+        "import ms")
+    print(header)
+    print("-" * len(header))
+    for scenario, result in results.items():
+        if scenario == 'render':
+            continue
+        for start in ("cold", "warm"):
+            r = result[start]
+            print("%-14s %-5s %6d %9.1f %9.1f %9.1f %9.1f %9.2f %8.2f %6d %6d %9s" % (
+                scenario, start, r['n'], r['p50'], r['p95'], r['p99'], r['max'], r['apiCalls'],
+                r['clients'], r['overDeadline'], r['errors'], result['importMs'] if start == "cold" else ""))
+    if 'render' in results:
+        r = results['render']
+        print("")
+        print("render %d findings: p50 %.2f ms, max %.2f ms" % (r['findings'], r['p50'], r['max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('--intents', nargs='+', default=sorted(SCENARIOS), choices=sorted(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=50, help="warm invocations per intent")
+    parser.add_argument('--cold', type=int, default=5, help="cold invocations per intent")
+    parser.add_argument('--regions', type=int, default=len(REGIONS), help="regions in FLASHREGIONS")
+    parser.add_argument('--findings', type=int, default=500, help="findings per region")
+    parser.add_argument('--maxresp', type=int, default=5)
+    parser.add_argument('--accounts', type=int, default=1, help="accounts findings are spread over, the first "
+                        "is the administrator")
+    parser.add_argument('--account-mode', default="", choices=["", "administrator", "assumerole"],
+                        help="ACCOUNTMODE for the function")
+    parser.add_argument('--latency-ms', type=float, default=50.0, help="base latency per API call")
+    parser.add_argument('--jitter-ms', type=float, default=50.0, help="random latency added per API call")
+    parser.add_argument('--throttle', type=float, default=0.0, help="probability an API call is throttled")
+    parser.add_argument('--response-cache-ttl', type=int, default=0,
+                        help="RESPONSECACHETTL for the function, 0 measures every request end to end")
+    parser.add_argument('--render', type=int, default=1000, help="findings in the render benchmark, 0 to skip")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    parser.add_argument('--importtime', action='store_true', help="report import cost of a cold start per intent")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    env = {'MAXRESP': str(args.maxresp), 'FLASHREGIONS': ",".join(REGIONS[:args.regions])}
+
+    if args.importtime:
+        results = importtimes(args, env)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            reportimports(results)
+        return
+
+    # Keep the function's own timing lines out of the report
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results = run(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,48 +12,175 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
-import boto3
+import json
 import os
+import random
 import re
-from collections import Counter
+import threading
+import time
+import heapq
+import zlib
+from bisect import bisect_right
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+# boto3, botocore and concurrent.futures are imported where they are first
+# needed, so requests that never call AWS (launch, help, stop) start faster.
 
 # Variables
 
-# Max number of findings to return. Although 50 can be returned without paginating,
-# keeping this below 15 is a good idea to avoid Alexa size limit.
+# Max number of findings to return. Responses are packed to fit the Alexa size
+# limit and SPEECHSECONDS, so a high value never gets a response rejected.
 MAXRESP = os.environ['MAXRESP']
 
+# Roughly how many seconds a response may take to speak. The most severe items
+# are packed in first and the rest summarized as "and N more".
+SPEECHSECONDS = int(os.environ.get('SPEECHSECONDS', '90'))
+
 # Comma separated list of region codes with NO spaces to include in flash briefing stats.
 # GuardDuty must be enabled in declared regions.
 FLASHREGIONS = os.environ['FLASHREGIONS']
 
+# Max number of regions queried in parallel for the flash briefing.
+MAXWORKERS = int(os.environ.get('MAXWORKERS', '8'))
+
+# Findings read for a ListFindings request. They are grouped by type before
+# the MAXRESP most severe groups are spoken, so repeats of one threat across
+# many resources take up a single sentence.
+FINDINGSCAN = int(os.environ.get('FINDINGSCAN', '50'))
+
+# Number of most common finding types spoken with statistics. 0 to leave them out.
+STATSTYPES = int(os.environ.get('STATSTYPES', '3'))
+
+# Seconds to wait for a region to respond before reporting it as not responding.
+# Keep well under the 8 second Alexa response deadline.
+REGIONTIMEOUT = float(os.environ.get('REGIONTIMEOUT', '5'))
+
+# Milliseconds a voice response may spend before answering, kept under the 8
+# second Alexa deadline. GuardDuty calls and retries stop when it runs out.
+RESPONSEBUDGET = int(os.environ.get('RESPONSEBUDGET', '7000'))
+
+# Attempts per GuardDuty call when throttled or when the endpoint fails.
+# Retries back off with full jitter and only while the response budget lasts.
+RETRYATTEMPTS = int(os.environ.get('RETRYATTEMPTS', '4'))
+RETRYBASE = float(os.environ.get('RETRYBASE', '0.1'))
+
+# Consecutive failed calls after which a region is skipped for BREAKERCOOLDOWN
+# seconds, so a degraded region does not slow down following invocations.
+BREAKERTHRESHOLD = int(os.environ.get('BREAKERTHRESHOLD', '3'))
+BREAKERCOOLDOWN = int(os.environ.get('BREAKERCOOLDOWN', '60'))
+
+# Seconds to cache a region's detector Id. Regions where GuardDuty is not
+# enabled are remembered for the shorter DETECTORNEGTTL.
+DETECTORTTL = int(os.environ.get('DETECTORTTL', '3600'))
+DETECTORNEGTTL = int(os.environ.get('DETECTORNEGTTL', '300'))
+
+# Where refresh_handler stores precomputed statistics. Empty to always query
+# GuardDuty live. One of: memory, file:/path/to/file.json, dynamodb:TableName
+SNAPSHOTSTORE = os.environ.get('SNAPSHOTSTORE', '')
+
+# Seconds a statistics snapshot is served before falling back to a live query.
+SNAPSHOTMAXAGE = int(os.environ.get('SNAPSHOTMAXAGE', '3600'))
+
+# Seconds a rendered ListFindings or ListStats response is reused for the same
+# question. 0 disables the response cache.
+RESPONSECACHETTL = int(os.environ.get('RESPONSECACHETTL', '60'))
+
+# Approximate bytes of rendered responses kept in memory across warm
+# invocations. The function only has 128 MB.
+RESPONSECACHEBYTES = int(os.environ.get('RESPONSECACHEBYTES', str(2 * 1024 * 1024)))
+
+# Where findings_handler keeps the findings index fed by GuardDuty finding
+# events. Empty to always query GuardDuty. One of: sqlite:/path/to/file.db,
+# sqlite::memory:, dynamodb:TableName
+FINDINGINDEX = os.environ.get('FINDINGINDEX', '')
+
+# Seconds since refresh_handler last reconciled a region's index with
+# GuardDuty before the region is queried live again. Archiving a finding
+# sends no event, so only a reconcile removes it from the index.
+FINDINGINDEXMAXAGE = int(os.environ.get('FINDINGINDEXMAXAGE', '21600'))
+
+# Aggregate statistics across GuardDuty member accounts. Empty for this
+# account only. 'administrator' queries this account's administrator detector
+# filtered by account Id, 'assumerole' assumes MEMBERROLE in each account.
+ACCOUNTMODE = os.environ.get('ACCOUNTMODE', '')
+
+# Comma separated list of member account Ids, optionally with a spoken name,
+# e.g. "111122223333:Production,444455556666:Staging". In administrator mode
+# an empty list means this account plus all associated members.
+MEMBERACCOUNTS = os.environ.get('MEMBERACCOUNTS', '')
+
+# Role assumed in each member account in assumerole mode
+MEMBERROLE = os.environ.get('MEMBERROLE', 'AskGuardDutyReadOnly')
+
+# Set to 1 to log cProfile statistics for every invocation. A single
+# invocation can also be profiled by adding "profile": true to the event.
+PROFILE = os.environ.get('PROFILE', '') == '1'
+
 
 def lambda_handler(event, context):
     """ Route the incoming request based on type (LaunchRequest, IntentRequest,
     etc.) The JSON body of the request is provided in the event parameter.
     """
-    print("event.session.application.applicationId=" +
-          event['session']['application']['applicationId'])
-
+    with invocation(event):
+        # GuardDuty finding events feed the findings index
+        if event.get('detail-type') == "GuardDuty Finding":
+            setdeadline(context)
+            return findings_handler(event, context)
+
+        # Scheduled snapshot refresh shares the function with the skill
+        if event.get('source') == "aws.events":
+            setdeadline(context)
+            return refresh_handler(event, context)
+        setdeadline(context, RESPONSEBUDGET)
+
+        print("event.session.application.applicationId=" +
+              event['session']['application']['applicationId'])
+
+        """
+        Uncomment this if statement and populate with your skill's application ID to
+        prevent someone else from configuring a skill that sends requests to this
+        function.
+        """
+        # if (event['session']['application']['applicationId'] !=
+        #         "amzn1.echo-sdk-ams.app.[unique-value-here]"):
+        #     raise ValueError("Invalid Application ID")
+
+        if event['session']['new']:
+            on_session_started({'requestId': event['request']['requestId']},
+                               event['session'])
+
+        if event['request']['type'] == "LaunchRequest":
+            return on_launch(event['request'], event['session'])
+        elif event['request']['type'] == "IntentRequest":
+            return on_intent(event['request'], event['session'])
+        elif event['request']['type'] == "SessionEndedRequest":
+            return on_session_ended(event['request'], event['session'])
+
+def refresh_handler(event, context):
+    """ Precompute statistics snapshots and reconcile the findings index for
+    FLASHREGIONS. Run on a schedule (EventBridge rule) so voice requests can be
+    answered without querying GuardDuty.
     """
-    Uncomment this if statement and populate with your skill's application ID to
-    prevent someone else from configuring a skill that sends requests to this
-    function.
+    print("refresh_handler regions=" + FLASHREGIONS)
+    if not SNAPSHOTSTORE and not FINDINGINDEX:
+        raise ValueError("Neither SNAPSHOTSTORE nor FINDINGINDEX is configured")
+    result = {}
+    if SNAPSHOTSTORE:
+        result.update(refreshsnapshots(FLASHREGIONS.split(",")))
+    if FINDINGINDEX:
+        result['Index'] = reconcileindex(FLASHREGIONS.split(","))
+    return result
+
+def findings_handler(event, context):
+    """ Upsert a GuardDuty finding event (EventBridge detail-type "GuardDuty
+    Finding") into the findings index. Archived findings are removed.
     """
-    # if (event['session']['application']['applicationId'] !=
-    #         "amzn1.echo-sdk-ams.app.[unique-value-here]"):
-    #     raise ValueError("Invalid Application ID")
-
-    if event['session']['new']:
-        on_session_started({'requestId': event['request']['requestId']},
-                           event['session'])
-
-    if event['request']['type'] == "LaunchRequest":
-        return on_launch(event['request'], event['session'])
-    elif event['request']['type'] == "IntentRequest":
-        return on_intent(event['request'], event['session'])
-    elif event['request']['type'] == "SessionEndedRequest":
-        return on_session_ended(event['request'], event['session'])
+    detail = event['detail']
+    print("findings_handler region=" + detail.get('region', '') + " id=" + detail.get('id', ''))
+    return indexfinding(detail)
 
 def on_session_started(session_started_request, session):
     """ Called when the session starts """
@@ -79,6 +206,7 @@ def on_intent(intent_request, session):
 
     intent = intent_request['intent']
     intent_name = intent_request['intent']['name']
+    tag(intent=intent_name)
 
     # Dispatch intent handlers
     if intent_name == "FlashBriefing":
@@ -87,8 +215,14 @@ def on_intent(intent_request, session):
         return set_region_in_session(intent, session)
     elif intent_name == "ListFindings":
         return list_findings(intent, session)
+    elif intent_name == "NextFindings":
+        return next_findings(intent, session)
     elif intent_name == "ListStats":
         return list_stats(intent, session)
+    elif intent_name == "WorstFindings":
+        return list_worst_findings(intent, session)
+    elif intent_name == "WhatsNew":
+        return get_whats_new(intent, session)
     elif intent_name == "AMAZON.CancelIntent" or intent_name == "AMAZON.StopIntent":
         return handle_session_end_request()
     elif intent_name == "AMAZON.HelpIntent":
@@ -106,7 +240,21 @@ def on_session_ended(session_ended_request, session):
 
 # --------------- Functions that control the skill's behavior ------------------
 
+# Responses that only depend on configuration, by builder name
+_PREBUILT = {}
+
+def prebuilt(build):
+    """ Build a static response on first use and reuse it across warm
+    invocations """
+    def response():
+        if build.__name__ not in _PREBUILT:
+            _PREBUILT[build.__name__] = build()
+        return _PREBUILT[build.__name__]
+    response.__name__ = build.__name__
+    return response
+
 # Initial welcome
+@prebuilt
 def get_welcome_response():
     session_attributes = {}
     card_title = "Ask GuardDuty Welcome"
@@ -125,84 +273,99 @@ def get_welcome_response():
 def create_selected_region(selected_region):
     return {"selectedRegion": selected_region}
 
+# Regions known by name as (region id, spoken name, other spoken names).
+# Regions added later are picked up from botocore's endpoint data.
+REGIONS = (
+    ("us-east-1", "Virginia", ("Northern Virginia",)),
+    ("us-east-2", "Ohio", ()),
+    ("us-west-1", "California", ("Northern California",)),
+    ("us-west-2", "Oregon", ()),
+    ("ca-central-1", "Canada", ("Central",)),
+    ("sa-east-1", "Sao Paulo", ()),
+    ("eu-central-1", "Frankfurt", ()),
+    ("eu-west-1", "Ireland", ()),
+    ("eu-west-2", "London", ()),
+    ("ap-south-1", "Mumbai", ()),
+    ("ap-northeast-1", "Tokyo", ()),
+    ("ap-northeast-2", "Seoul", ()),
+    ("ap-southeast-1", "Singapore", ()),
+    ("ap-southeast-2", "Sydney", ()),
+)
+
+# region id -> spoken name, and casefolded spoken name or id -> region id
+_REGIONNAMES = {}
+_REGIONALIASES = {}
+_BOTOCOREREGIONS = []
+
+# Add a region to the registry. Names already registered are kept.
+def addregion(region_id, name, aliases=()):
+    _REGIONNAMES.setdefault(region_id, name)
+    for alias in (region_id, name) + tuple(aliases):
+        _REGIONALIASES.setdefault(alias.casefold(), region_id)
+
+for _region in REGIONS:
+    addregion(*_region)
+
+# Spoken name in a botocore region description, e.g. "Asia Pacific (Osaka)"
+REGIONDESCRIPTION = re.compile(r'\(([^()]+)\)\s*$')
+
+# Region ids of real regional endpoints, for partitions without a regionRegex.
+# Pseudo-regions such as aws-global do not match.
+REGIONID = r'^[a-z]+(-[a-z]+)+-\d+$'
+
+# Register regions from botocore's bundled endpoint data, once per container.
+# Regions without a spoken name in their description are skipped.
+def loadbotocoreregions():
+    if _BOTOCOREREGIONS:
+        return
+    _BOTOCOREREGIONS.append(True)
+    try:
+        from botocore.loaders import Loader
+        endpoints = Loader().load_data('endpoints')
+    except Exception as e:
+        print("loadbotocoreregions error=" + repr(e))
+        return
+    for partition in endpoints.get('partitions', []):
+        regionid = re.compile(partition.get('regionRegex', REGIONID))
+        for region_id, region in partition.get('regions', {}).items():
+            name = REGIONDESCRIPTION.search(region.get('description', ''))
+            if name and regionid.match(region_id):
+                addregion(region_id, name.group(1).strip())
+
 # Return region ID
 def get_region_id(selectedRegion):
-    if selectedRegion in {"Virginia", "virginia", "Northern Virginia", "northern virginia", "northern Virginia"}:
-        return {"regionId": "us-east-1"}
-    elif selectedRegion in {"Ohio", "ohio"}:
-        return {"regionId": "us-east-2"}
-    elif selectedRegion in {"Frankfurt", "frankfurt"}:
-        return {"regionId": "eu-central-1"}
-    elif selectedRegion in {"California", "california", "Northern California", "northern california", "northern California"}:
-        return {"regionId": "us-west-1"}
-    elif selectedRegion in {"Oregon", "oregon"}:
-        return {"regionId": "us-west-2"}
-    elif selectedRegion in {"London", "london"}:
-        return {"regionId": "eu-west-2"}
-    elif selectedRegion in {"Ireland", "ireland"}:
-        return {"regionId": "eu-west-1"}
-    elif selectedRegion in {"Singapore", "singapore"}:
-        return {"regionId": "ap-southeast-1"}
-    elif selectedRegion in {"Sydney", "sydney"}:
-        return {"regionId": "ap-southeast-2"}
-    elif selectedRegion in {"Canada", "canada", "Central", "central"}:
-        return {"regionId": "ca-central-1"}
-    elif selectedRegion in {"Sao Paulo", "sao paulo", "sao Paulo"}:
-        return {"regionId": "sa-east-1"}
-    elif selectedRegion in {"Seoul", "seoul"}:
-        return {"regionId": "ap-northeast-2"}
-    elif selectedRegion in {"Mumbai", "mumbai"}:
-        return {"regionId": "ap-south-1"}
-    elif selectedRegion in {"Tokyo", "tokyo"}:
-        return {"regionId": "ap-northeast-1"}
-    else:
-        return {"regionId": "Unknown"}
+    alias = str(selectedRegion).strip().casefold()
+    if alias not in _REGIONALIASES:
+        loadbotocoreregions()
+    return {"regionId": _REGIONALIASES.get(alias, "Unknown")}
 
 # Return region friendly name
 def get_region_name(region_id):
-    if region_id == "us-east-1":
-        return {"regionName": "Virginia"}
-    elif region_id == "us-east-2":
-        return {"regionName": "Ohio"}
-    elif region_id == "us-west-1":
-        return {"regionName": "California"}
-    elif region_id == "eu-central-1":
-        return {"regionName": "Frankfurt"}
-    elif region_id == "us-west-2":
-        return {"regionName": "Oregon"}
-    elif region_id == "eu-west-2":
-        return {"regionName": "London"}
-    elif region_id == "ap-southeast-1":
-        return {"regionName": "Singapore"}
-    elif region_id == "ap-southeast-2":
-        return {"regionName": "Sydney"}
-    elif region_id == "eu-west-1":
-        return {"regionName": "Ireland"}
-    elif region_id == "ca-central-1":
-        return {"regionName": "Canada"}
-    elif region_id == "sa-east-1":
-        return {"regionName": "Sao Paulo"}
-    elif region_id == "ap-northeast-2":
-        return {"regionName": "Seoul"}
-    elif region_id == "ap-south-1":
-        return {"regionName": "Mumbai"}
-    elif region_id == "ap-northeast-1":
-        return {"regionName": "Tokyo"}
-    else:
-        return {"regionName": ""}
+    if region_id not in _REGIONNAMES:
+        loadbotocoreregions()
+    return {"regionName": _REGIONNAMES.get(region_id, "")}
 
 # Get GuardDuty Flash Briefing
 def get_flash_briefing(intent, session):
     session_attributes = {}
     card_title = "Ask GuardDuty Flash Briefing"
     should_end_session = False
-    flashglobal = getflashbrief()[0]
-    flashregion = getflashbrief()[1]
-
-    if flashglobal:
-        speech_output = "<speak> Here is your GuardDuty flash briefing." \
-                        " <break time='.3s'/>Globally, there are, " + str(flashglobal) + " findings." \
-                        " <break time='.5s'/>Here are the regional finding statistics: " + str(flashregion) + ".</speak>"
+    brief = getflashbrief()
+
+    if brief['GlobalSpeech']:
+        speech_output = Speech("<speak> Here is your GuardDuty flash briefing." \
+                        " <break time='.3s'/>Globally, there are, ").join(brief['GlobalSpeech']).say(" findings.")
+        if brief['TypeSpeech']:
+            speech_output.say(" <break time='.3s'/>The most common finding types are, ").join(brief['TypeSpeech']).say(".")
+        speech_output.say(" <break time='.5s'/>Here are the regional finding statistics: ").join(brief['RegionSpeech']).say(
+                        "." + brief['AgeSSML'] + "</speak>")
+    elif not any(region['Status'] == "ok" for region in brief['Regions']):
+        # No region answered, which is not the same as no findings
+        speech_output = Speech("<speak>Your GuardDuty flash briefing could not be retrieved.").join(
+                        brief['ProblemSpeech']).say(" <break time='.3s'/>Please try again later.</speak>")
+    elif brief['ProblemSpeech']:
+        speech_output = Speech("<speak>There are no current GuardDuty findings in the regions that answered.").join(
+                        brief['ProblemSpeech']).say("</speak>")
     else:
         speech_output = "<speak>There are no current GuardDuty findings for the selected AWS regions." \
                         " <break time='.2s'/>  You can generate samples in the console and GuardDuty will" \
@@ -241,25 +404,42 @@ def list_findings(intent, session):
         except KeyError:
             min_sev = '0'
 
-    # In case GD is not enabled for selected region.
+    # Serve repeated questions from the response cache unless asked to refresh
+    refresh = wantsrefresh(intent)
+    cache_key = ("ListFindings", region_name, min_sev, MAXRESP)
+    response = None if refresh else RESPONSES.get(cache_key)
+    if response is not None:
+        return response
+
+    # [0] in case GD is not enabled for selected region, or the call failed
     try:
-        gdfindings = getfindings(minsev=min_sev, region_name=region_name)['Findings']
-    except TypeError:
+        page = None if refresh else indexpage(min_sev, region_name)
+        if page is None:
+            page = withinbudget(region_name, lambda: readpage(min_sev, region_name, None) if refresh
+                                else getpage(min_sev, region_name, None))
+        gdfindings = groupfindings(page['Findings']) if page else [0]
+    except Exception as e:
+        print("list_findings region=" + region_name + " error=" + repr(e))
         gdfindings = [0]
 
     sgdfindings = []
 
     if 'selectedRegion' in intent['slots'] and gdfindings != [0]:
         selected_region = intent['slots']['selectedRegion']['value']
-        for f in gdfindings:
-            sevname = getsevname(str(f['Severity']))['SeverityName']
-            description = str(f['Title'])
-            sgdfindings.append("Severity, " + sevname + ", <break time='.2s'/>" + "Count, " + str(f['Service']['Count']) + ", <break time='.2s'/>" + description)
-            # Clean up output
-            findings = scruboutput(inputtxt = str(sgdfindings))
+        candidates = gdfindings[:int(MAXRESP)]
+        for g in candidates:
+            sgdfindings.append(describegroup(g))
+        chosen = pack(sgdfindings, [groupvalue(g) for g in candidates])
 
         if gdfindings:
-            speech_output = "<speak>Here are up to " + MAXRESP + " GuardDuty findings for, " + selected_region + ", with minimum severity " + str(min_sev) + ". <break time='.5s'/> " + str(findings) + "</speak>"
+            spoken = [candidates[i] for i in chosen]
+            cursor = advancecursor(newcursor(region_name, min_sev, page), page, spoken)
+            session_attributes['Cursor'] = cursor
+            speech_output = Speech("<speak>Here are up to " + MAXRESP + " GuardDuty findings, grouped by type, for, " + selected_region + ", with minimum severity " + str(min_sev) + ". <break time='.5s'/> ").join(
+                [sgdfindings[i] for i in chosen]).say(moreitems(len(gdfindings) - len(spoken), "finding types"))
+            if cursor['More']:
+                speech_output.say(". <break time='.5s'/>For more, say, next findings.")
+            speech_output.say("</speak>")
         else:
             speech_output = "<speak>There are no current GuardDuty findings for, " + selected_region + ", with minimum severity " + str(min_sev) + ".</speak>"
 
@@ -271,9 +451,173 @@ def list_findings(intent, session):
                     " finding details by saying for example, get high severity findings for Oregon. You can also get " \
                     " global statistics by saying, <break time='.2s'/> Get flash briefing. For additional information, you can say, Help.</speak>"
 
+    response = build_response(session_attributes, build_speechlet_response(
+        card_title, speech_output, reprompt_text, should_end_session))
+    if gdfindings != [0]:
+        RESPONSES.put(cache_key, response)
+    return response
+
+# Continue the last finding details request from its session cursor
+def next_findings(intent, session):
+    session_attributes = dict(session.get('attributes') or {})
+    card_title = "Ask GardDuty Finding Details"
+    should_end_session = False
+    cursor = session_attributes.get('Cursor')
+    selected_region = session_attributes.get('selectedRegion', "")
+
+    reprompt_text = "<speak>Are you still there? <break time='.3s'/> For more findings, you can say, next findings." \
+                    " Or get finding details for another region by saying for example, get high severity findings for Oregon." \
+                    " For additional information, you can say, Help.</speak>"
+
+    if not cursor:
+        speech_output = "<speak>Ask for findings first, for example, get high severity findings for Oregon.</speak>"
+        return build_response(session_attributes, build_speechlet_response(
+            card_title, speech_output, reprompt_text, should_end_session))
+
+    try:
+        page, groups = withinbudget(cursor['Region'], lambda: nextgroups(cursor))
+    except Exception as e:
+        print("next_findings region=" + cursor['Region'] + " error=" + repr(e))
+        speech_output = "<speak>The was a problem retrieving the information. Please confirm GuardDuty" \
+                        " is enabled in the " + selected_region + " region.</speak>"
+        return build_response(session_attributes, build_speechlet_response(
+            card_title, speech_output, reprompt_text, should_end_session))
+
+    if groups:
+        sgroups = [describegroup(g) for g in groups]
+        chosen = pack(sgroups, [groupvalue(g) for g in groups])
+        session_attributes['Cursor'] = advancecursor(cursor, page, [groups[i] for i in chosen])
+        speech_output = Speech("<speak>Here are the next GuardDuty findings for, " + selected_region + ". <break time='.5s'/> ").join(
+            [sgroups[i] for i in chosen])
+        if session_attributes['Cursor']['More']:
+            speech_output.say(". <break time='.5s'/>For more, say, next findings.")
+        speech_output.say("</speak>")
+    elif page and page['NextToken']:
+        session_attributes['Cursor'] = advancecursor(cursor, page, groups)
+        speech_output = "<speak>The next findings for, " + selected_region + ", are more of the types you already heard." \
+                        " <break time='.3s'/>To keep looking, say, next findings.</speak>"
+    else:
+        session_attributes.pop('Cursor', None)
+        speech_output = "<speak>There are no more GuardDuty findings for, " + selected_region + ", with minimum severity " + str(cursor['MinSev']) + ".</speak>"
+
+    return build_response(session_attributes, build_speechlet_response(
+        card_title, speech_output, reprompt_text, should_end_session))
+
+# Get the most severe findings across the flash briefing regions
+def list_worst_findings(intent, session):
+    session_attributes = {}
+    card_title = "Ask GuardDuty Worst Findings"
+    should_end_session = False
+
+    worst, missing = topfindings(minsev=0, regions=FLASHREGIONS.split(","), n=int(MAXRESP))
+
+    sworst = []
+    values = []
+    for f in worst:
+        rn = get_region_name(f.Region)['regionName'] or f.Region
+        sworst.append(Speech("In " + rn + ", <break time='.2s'/>").join([describefinding(f)]))
+        values.append((f.Severity, f.Count))
+    for r in missing:
+        sworst.append(Speech("<break time='.3s'/>" + (get_region_name(r)['regionName'] or r) + " did not respond in time"))
+        values.append((float('inf'), 0))
+    chosen = pack(sworst, values)
+    spoken = len([i for i in chosen if i < len(worst)])
+
+    if worst:
+        speech_output = Speech("<speak>Here are the " + str(spoken) + " most severe GuardDuty findings across your flash briefing regions." \
+                        " <break time='.5s'/> ").join([sworst[i] for i in chosen]).say(
+                        moreitems(len(worst) - spoken, "findings")).say("</speak>")
+    elif missing:
+        speech_output = Speech("<speak>I could not retrieve findings in time. <break time='.3s'/> ").join(sworst).say("</speak>")
+    else:
+        speech_output = "<speak>There are no current GuardDuty findings for the selected AWS regions.</speak>"
+
+    reprompt_text = "<speak>Are you still there? <break time='.3s'/> You can get GuardDuty" \
+                    " finding details by saying for example, get high severity findings for Oregon. You can also get " \
+                    " global statistics by saying, <break time='.2s'/> Get flash briefing. For additional information, you can say, Help.</speak>"
+
+    return build_response(session_attributes, build_speechlet_response(
+        card_title, speech_output, reprompt_text, should_end_session))
+
+# Get changes since the user last asked
+def get_whats_new(intent, session):
+    session_attributes = {}
+    card_title = "Ask GuardDuty What's New"
+    should_end_session = False
+
+    delta = getdelta(session['user']['userId'])
+
+    if delta['Since'] is None and not delta['Saved']:
+        # Some region did not answer, so there is no baseline to start from
+        brief = delta['Brief']
+        speech_output = Speech("<speak>I could not check all of your flash briefing regions, so I will start keeping" \
+                               " track next time.")
+        if brief['GlobalSpeech']:
+            speech_output.say(" <break time='.3s'/>In the regions that answered, there are, ").join(
+                brief['GlobalSpeech']).say(" findings.")
+        speech_output.join(brief['ProblemSpeech']).say("</speak>")
+    elif delta['Since'] is None:
+        brief = delta['Brief']
+        if brief['GlobalSpeech']:
+            speech_output = Speech("<speak>I will remember where you left off. <break time='.3s'/>Right now there are, ").join(
+                brief['GlobalSpeech']).say(" findings across your flash briefing regions.</speak>")
+        else:
+            speech_output = "<speak>I will remember where you left off. <break time='.3s'/>There are no current" \
+                            " GuardDuty findings for the selected AWS regions.</speak>"
+    else:
+        since = sinceago(delta['Since'])
+        schanges = []
+        for region in delta['Regions']:
+            if region['Status'] != "ok":
+                schanges.append(Speech("<break time='.3s'/>" + region['RegionName'] + " did not respond in time"))
+            elif region['Updated']:
+                schanges.append(Speech("<break time='.5s'/>In " + region['RegionName'] + ", ").join(
+                    [Speech("<break time='.2s'/>" + str(n) + " " + band + " severity") for band, n in region['Updated'].items()]))
+        if delta['Total']:
+            speech_output = Speech("<speak>Since you last asked " + since + ", " + str(delta['Total']) +
+                                   (" finding was" if delta['Total'] == 1 else " findings were") + " new or updated." \
+                                   " ").join(schanges).say(".</speak>")
+        elif schanges:
+            speech_output = Speech("<speak>Nothing has changed since you last asked " + since + " in the regions that answered." \
+                                   " ").join(schanges).say(".</speak>")
+        else:
+            speech_output = "<speak>Nothing has changed since you last asked " + since + ".</speak>"
+
+    reprompt_text = "<speak>Are you still there? <break time='.3s'/> For the full picture, you can say," \
+                    " <break time='.2s'/> Get flash briefing. For additional information, you can say, Help.</speak>"
+
     return build_response(session_attributes, build_speechlet_response(
         card_title, speech_output, reprompt_text, should_end_session))
 
+# Return spoken description of a finding. The title is redacted here, once.
+def describefinding(f):
+    sevname = getsevname(str(f.Severity))['SeverityName']
+    return Speech("Severity, " + sevname + ", <break time='.2s'/>" + "Count, " + str(f.Count) + ", <break time='.2s'/>").redact(f.Title)
+
+# Spoken plural of the resources a finding group is about, by ResourceType
+RESOURCENOUNS = {
+    "Instance": "instances",
+    "AccessKey": "access keys",
+    "S3Bucket": "buckets",
+    "EKSCluster": "clusters"
+}
+
+# Return how much a finding group is worth saying, for pack()
+def groupvalue(g):
+    return (g.Severity, g.Count)
+
+# Return spoken description of a finding group. A group of one is described
+# like the finding itself.
+def describegroup(g):
+    if g.Findings == 1:
+        return describefinding(g.First)
+    sevname = getsevname(str(g.Severity))['SeverityName']
+    speech = Speech("Severity, " + sevname + ", <break time='.2s'/>").redact(_TYPEWORDS.sub(" ", g.Type) or g.Title)
+    speech.say(", " + str(g.Count) + " occurrences")
+    if g.Resources > 1:
+        speech.say(" across " + str(g.Resources) + " " + RESOURCENOUNS.get(g.ResourceType, "resources"))
+    return speech
+
 # Get statistics by region.
 def list_stats(intent, session):
     session_attributes = {}
@@ -294,22 +638,39 @@ def list_stats(intent, session):
         return build_response(session_attributes, build_speechlet_response(
             card_title, speech_output, reprompt_text, should_end_session))
 
-    try:
-        gdstats = getstats(region_name=region_name)['FindingStatistics']['CountBySeverity']
-    # In case GD is not enabled for selected region.
-    except TypeError or KeyError:
-        gdstats = [0]
+    # Serve repeated questions from the response cache unless asked to
+    # refresh, in which case snapshots are skipped as well
+    refresh = wantsrefresh(intent)
+    cache_key = ("ListStats", region_name, None, MAXRESP)
+    response = None if refresh else RESPONSES.get(cache_key)
+    if response is not None:
+        return response
+
+    snapshot = None if refresh else (getindexed([region_name]).get(region_name) or
+                                     getsnapshots([region_name]).get(region_name))
+    if snapshot:
+        gdstats = statssummary(snapshot['CountBySeverity'], snapshot['CountByType'])
+        age = snapshotage(snapshot['Age'])
+    else:
+        age = ""
+        # [0] in case GD is not enabled for selected region, or the call failed
+        try:
+            gdstats = withinbudget(region_name, lambda: getstats(region_name=region_name))
+            gdstats = statssummary(gdstats['FindingStatistics']['CountBySeverity'],
+                                   findingtypes(gdstats)) if gdstats else [0]
+        except Exception as e:
+            print("list_stats region=" + region_name + " error=" + repr(e))
+            gdstats = [0]
 
-    sgdstats = []
     if 'selectedRegion' in intent['slots'] and gdstats != [0]:
         selected_region = intent['slots']['selectedRegion']['value']
-        for key, value in gdstats.items():
-            sevname = getsevname(key)['SeverityName']
-            sgdstats.append("<break time='.3s'/> " + str(value) + " " + sevname + " severity")
-            # Clean up output
-            stats = scruboutput(inputtxt = str(sgdstats))
+        sgdstats = renderbands(gdstats['Bands'], ".3s")
         if sgdstats:
-            speech_output = "<speak> In " + selected_region + ", there are currently, " + str(stats) + " findings. <break time='1s'/>  </speak>"
+            speech_output = Speech("<speak> In " + selected_region + ", there are currently, ").join(sgdstats).say(" findings.")
+            if gdstats['Types']:
+                speech_output.say(" <break time='.3s'/>The most common finding types are, ").join(
+                    rendertypes(gdstats['Types'])).say(".")
+            speech_output.say(age + " <break time='1s'/>  </speak>")
         else:
             speech_output = "<speak>There are no current findings in " + selected_region + "." \
                             " <break time='.2s'/> You can generate samples in the console and GuardDuty will" \
@@ -324,10 +685,14 @@ def list_stats(intent, session):
                     "<break time='.2s'/> Get flash briefing. For additional information, you can say, Help.</speak>"
 
 
-    return build_response(session_attributes, build_speechlet_response(
+    response = build_response(session_attributes, build_speechlet_response(
         card_title, speech_output, reprompt_text, should_end_session))
+    if gdstats != [0]:
+        RESPONSES.put(cache_key, response)
+    return response
 
 # Get Help
+@prebuilt
 def get_help():
     session_attributes = {}
     card_title = "Ask GuardDuty Help"
@@ -343,7 +708,9 @@ def get_help():
                     " You can also get finding statistics for a region by saying for example, get statistics for Oregon." \
                     " I can retrieve information for other AWS regions where GuardDuty is enabled." \
                     " You can get GuardDuty finding details by saying for example," \
-                    " get high severity findings for California." \
+                    " get high severity findings for California. To hear more, say, next findings." \
+                    " To hear the most severe findings across all flash briefing regions, say, get worst findings." \
+                    " To hear only what changed since you last asked, say, what's new." \
                     " I am currently configured to return up to " + MAXRESP + " findings in a response." \
                     " Each GuardDuty finding has an assigned severity level and value that can help you determine your  " \
                     " response to a potential security issue that is highlighted by a finding. The value of the severity " \
@@ -359,166 +726,1348 @@ def get_help():
     return build_response(session_attributes, build_speechlet_response(
         card_title, speech_output, reprompt_text, should_end_session))
 
+# Clients are created once per region, service and account and reused across
+# warm invocations. boto3.client() itself is not thread safe, so construction
+# is done under a lock. Clients for member accounts are rebuilt when their
+# assumed role credentials are renewed.
+_CLIENTS = {}
+_CLIENTKEYS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+# Return a shared boto3 client for region, in a member account if given
+def getclient(region_name, service='guardduty', account=None):
+    key = (service, region_name, account)
+    credentials = getcredentials(account) if account else None
+    access_key = credentials['AccessKeyId'] if credentials else None
+    client = _CLIENTS.get(key)
+    if client is None or _CLIENTKEYS.get(key) != access_key:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None or _CLIENTKEYS.get(key) != access_key:
+                import boto3
+                from botocore.config import Config
+                # botocore's own retries are turned off, retrying() retries
+                # within the response budget instead
+                config = Config(retries={'max_attempts': 0}, connect_timeout=2, read_timeout=REGIONTIMEOUT)
+                if credentials:
+                    client = boto3.client(service, region_name=region_name,
+                                          aws_access_key_id=credentials['AccessKeyId'],
+                                          aws_secret_access_key=credentials['SecretAccessKey'],
+                                          aws_session_token=credentials['SessionToken'],
+                                          config=config)
+                else:
+                    client = boto3.client(service, region_name=region_name, config=config)
+                _CLIENTS[key] = client
+                _CLIENTKEYS[key] = access_key
+    return client
+
+# Assumed role credentials by member account, renewed shortly before expiry
+_CREDENTIALS = {}
+_CREDENTIALS_LOCKS = {}
+
+# Return credentials for MEMBERROLE in account
+def getcredentials(account):
+    credentials = _CREDENTIALS.get(account)
+    if credentials and credentials['Expires'] - time.time() > 300:
+        return credentials
+    # One lock per account so accounts are assumed in parallel
+    with _CREDENTIALS_LOCKS.setdefault(account, threading.Lock()):
+        credentials = _CREDENTIALS.get(account)
+        if credentials and credentials['Expires'] - time.time() > 300:
+            return credentials
+        with span('assume_role', account=account):
+            response = stscall('assume_role',
+                RoleArn="arn:aws:iam::" + account + ":role/" + MEMBERROLE,
+                RoleSessionName="AskGuardDuty")['Credentials']
+        credentials = dict(response)
+        credentials['Expires'] = response['Expiration'].timestamp()
+        _CREDENTIALS[account] = credentials
+    return credentials
+
+# Detector Ids by (region, account) as (detector_id, expires). Survives warm
+# invocations.
+_DETECTORS = {}
+
+# Errors from a call made with a cached detector Id that mean it is stale
+DETECTORERRORS = ('BadRequestException', 'ResourceNotFoundException')
+
+# Call a GuardDuty API operation in region, timed as a span per attempt.
+# Throttled and failed calls are retried by retrying().
+def gdcall(region_name, operation, account=None, **kwargs):
+    def attempt(n):
+        attrs = {'region': region_name, 'attempt': n} if n else {'region': region_name}
+        with span(operation, **attrs):
+            return getattr(getclient(region_name, account=account), operation)(**kwargs)
+    return retrying(region_name, attempt)
+
+# Call an STS API operation in the function's own region, with the same
+# retries and response budget as GuardDuty calls
+def stscall(operation, **kwargs):
+    region_name = os.environ.get('AWS_REGION')
+
+    def attempt(n):
+        return getattr(getclient(region_name, 'sts'), operation)(**kwargs)
+    return retrying("sts", attempt)
+
 # Return GuardDuty detector Id for region
-def getdetectorid(region_name):
-    gdclient = boto3.client('guardduty', region_name=region_name)
+def getdetectorid(region_name, account=None):
+    now = time.time()
+    cached = _DETECTORS.get((region_name, account))
+    if cached and cached[1] > now:
+        return cached[0]
+    with span('detector', region=region_name):
+        return lookupdetectorid(region_name, account, now)
+
+# Return detector Id for region from GuardDuty and cache it
+def lookupdetectorid(region_name, account, now):
     try:
-        response = gdclient.list_detectors()['DetectorIds'][0]
+        response = gdcall(region_name, 'list_detectors', account=account)['DetectorIds'][0]
     except IndexError:
         response = []
+    ttl = DETECTORTTL if response else DETECTORNEGTTL
+    _DETECTORS[(region_name, account)] = (response, now + ttl)
     return response
 
+# Forget the cached detector Id for region
+def invalidatedetector(region_name, account=None):
+    _DETECTORS.pop((region_name, account), None)
+
+# Return the error code of a botocore ClientError, or None
+def errorcode(error):
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+# Return call(detector_id) for region, or [] if GuardDuty is not enabled.
+# If the call fails because the cached detector Id went stale, the cache is
+# invalidated and the call retried once with a fresh Id.
+def withdetector(region_name, call, account=None):
+    detector_id = getdetectorid(region_name, account)
+    if not detector_id:
+        return []
+    try:
+        return call(detector_id)
+    except Exception as e:
+        if errorcode(e) not in DETECTORERRORS:
+            raise
+        invalidatedetector(region_name, account)
+        fresh_id = getdetectorid(region_name, account)
+        if not fresh_id:
+            return []
+        if fresh_id == detector_id:
+            raise
+        return call(fresh_id)
+
+# Severity bands by lower bound: below 4.0 is Low, 4.0 up to 7.0 is Medium,
+# 7.0 and above is High.
+SEVBOUNDS = (4.0, 7.0)
+SEVNAMES = ("Low", "Medium", "High")
+
+# Severity values by band name, for finding criteria
+SEVVALUES = {
+    "low": {"MinSev": "0", "MaxSev": "3.9"},
+    "medium": {"MinSev": "4", "MaxSev": "6.9"},
+    "high": {"MinSev": "7", "MaxSev": "10"}
+}
+
+# Band names by severity as reported by GuardDuty, e.g. "5.0"
+_SEVBANDS = {}
+
 # Return finding severity name based on value
 def getsevname(sevlevel):
-    if float(sevlevel) < 4:
-        return {"SeverityName": "Low"}
-    elif 4 < float(sevlevel) < 7:
-        return {"SeverityName": "Medium"}
-    elif float(sevlevel) > 7:
-        return {"SeverityName": "High"}
-    else:
-        return {"SeverityName": sevlevel}
+    name = _SEVBANDS.get(sevlevel)
+    if name is None:
+        name = SEVNAMES[bisect_right(SEVBOUNDS, float(sevlevel))]
+        _SEVBANDS[sevlevel] = name
+    return {"SeverityName": name}
+
+# Return counts summed by severity band, most severe band first
+def bandcounts(countbyseverity):
+    bands = Counter()
+    for key, value in countbyseverity.items():
+        bands[getsevname(key)['SeverityName']] += int(value)
+    return dict((name, bands[name]) for name in reversed(SEVNAMES) if bands[name])
+
+# Return a statistics summary that every response renders from:
+#   Total: number of findings
+#   Bands: count by severity band, most severe band first
+#   Types: up to STATSTYPES most common finding types as Type and Count
+def statssummary(countbyseverity, countbytype=None):
+    bands = bandcounts(countbyseverity)
+    types = Counter(countbytype or {}).most_common(STATSTYPES) if STATSTYPES else []
+    return {"Total": sum(bands.values()), "Bands": bands,
+            "Types": [{"Type": t, "Count": n} for t, n in types]}
+
+# Return finding counts by type from a get_findings_statistics response grouped
+# by FINDING_TYPE, {} if it was not grouped
+def findingtypes(stats):
+    grouped = stats['FindingStatistics'].get('GroupedByFindingType') or []
+    return dict((g['FindingType'], int(g['TotalFindings'])) for g in grouped)
+
+# Return Speech items for counts by severity band
+def renderbands(bands, pause=".2s"):
+    return [Speech("<break time='" + pause + "'/>" + str(n) + " " + band + " severity") for band, n in bands.items()]
+
+# Word boundaries in finding types such as Recon:EC2/PortProbeUnprotectedPort,
+# including after acronyms as in UnauthorizedAccess:EC2/SSHBruteForce
+_TYPEWORDS = re.compile(r'[:/.!]+|(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+
+# Return Speech items for the most common finding types
+def rendertypes(types):
+    return [Speech("<break time='.2s'/>").redact(_TYPEWORDS.sub(" ", t['Type'])).say(", " + str(t['Count']))
+            for t in types]
 
 # Return finding value value based on severity
 def getsevvalue(sevname):
-    if sevname == "low":
-        return {"MinSev": "0", "MaxSev": "3.9"}
-    if sevname == "medium":
-        return {"MinSev": "4", "MaxSev": "6.9"}
-    if sevname == "high":
-        return {"MinSev": "7", "MaxSev": "10"}
-    else:
-        return {"MinSev": "0", "MaxSev": "10"}
+    return dict(SEVVALUES.get(str(sevname).casefold(), {"MinSev": "0", "MaxSev": "10"}))
 
 # List regions declared in FLASHREGIONS by name
 def getflashregions():
     flashregions = []
-    try:
-        regionids = FLASHREGIONS.split(",")
-        for r in regionids:
-            flashregions.append(get_region_name(r)['regionName'])
-            # Clean up output
-            response = scruboutput(inputtxt = str(flashregions))
-    except IndexError or NameError:
-        response = []
-    return response
-
-# Redact stuff from findings and clean up output for card display
-def scruboutput(inputtxt):
-    response = re.sub('&', 'and', inputtxt)
-    response = re.sub(r'[\[\]\"]', '', response)
-    response = re.sub(r'instance i-(\w+)', 'instance', response)
-    response = re.sub(r'i-(\w{1,17}\b)', 'EC2 instance', response)
-    response = re.sub(r'against i-(\w+)', 'against an EC2 instance', response)
-    response = re.sub(r'([0-9]+)(?:\.[0-9]+){3}', 'IP host', response)
-    return response
-
-# ReturnGuardDuty Flash Briefing
+    for r in FLASHREGIONS.split(","):
+        flashregions.append(get_region_name(r)['regionName'] or r)
+    return ", ".join(flashregions)
+
+# Run func(region) for each region in parallel with bounded concurrency.
+# Returns (region, result, error) tuples in the same order as regions. Regions
+# that have not answered within timeout seconds of starting get the error
+# 'timeout'. With more regions than MAXWORKERS, a region's timeout starts when
+# a worker picks it up, so regions queued behind slow ones are not cut short.
+# The response budget still bounds the whole call.
+def fanout(func, regions, timeout=REGIONTIMEOUT):
+    if not regions:
+        return []
+    from concurrent.futures import ThreadPoolExecutor
+    workers = max(1, min(MAXWORKERS, len(regions)))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    # Stragglers keep their worker after timing out, so regions queued behind
+    # them are still bounded by one timeout per round of workers
+    until = None if timeout is None else time.time() + timeout * -(-len(regions) // workers)
+    changed = threading.Condition()
+    started = {}
+    trace = currenttrace()
+
+    def run(i):
+        with changed:
+            started[i] = time.time()
+            changed.notify()
+        return withtrace(trace, func, regions[i])
+
+    def finished(future):
+        with changed:
+            changed.notify()
+
+    futures = [executor.submit(run, i) for i in range(len(regions))]
+    for f in futures:
+        f.add_done_callback(finished)
+    expired = set()
+    with changed:
+        while True:
+            now = time.time()
+            waits = []
+            for i, f in enumerate(futures):
+                if f.done() or i in expired or i not in started or timeout is None:
+                    continue
+                if now - started[i] >= timeout:
+                    expired.add(i)
+                else:
+                    waits.append(started[i] + timeout - now)
+            if all(f.done() or i in expired for i, f in enumerate(futures)):
+                break
+            if until is not None:
+                if now >= until:
+                    break
+                waits.append(until - now)
+            left = budgeted(None)
+            if left is not None:
+                if left <= 0:
+                    break
+                waits.append(left)
+            changed.wait(min(waits) if waits else None)
+    # Do not block the voice response on stragglers
+    executor.shutdown(wait=False)
+    results = []
+    for i, (r, f) in enumerate(zip(regions, futures)):
+        if i in expired or not f.done():
+            f.cancel()
+            results.append((r, None, 'timeout'))
+        elif f.exception() is not None:
+            results.append((r, None, f.exception()))
+        else:
+            results.append((r, f.result(), None))
+    return results
+
+# Return GuardDuty Flash Briefing. Regions are served from the findings index
+# or statistics snapshots when available, otherwise every region in FLASHREGIONS is queried
+# exactly once. The result is shared by the speech, card and reprompt.
+#   Totals:     severity -> count summed across regions
+#   Summary:    statssummary() of the totals and finding types
+#   Regions:    per region breakdown with RegionId, RegionName, Status,
+#               CountBySeverity, CountByType, CountByAccount and Summary.
+#               Status is one of ok, not_enabled, timeout, error.
+#   Accounts:   per account totals with AccountId, AccountName,
+#               CountBySeverity and Summary, empty unless ACCOUNTMODE is set
+#   SnapshotAge: seconds since the oldest snapshot used was taken, or None
+#   GlobalSpeech: rendered global totals by band, one Speech per line
+#   TypeSpeech: rendered most common finding types, one Speech per line
+#   RegionSpeech: rendered regional statistics, one Speech per line
+#   ProblemSpeech: rendered regions that did not answer or do not have
+#               GuardDuty enabled, one Speech per line
+#   AgeSSML:    how old the snapshot statistics are, if any were used
 def getflashbrief():
     # set the target regions to aggregate findng stats
     targ_regions = FLASHREGIONS.split(",")
-    flashglobal = []
-    flashregion = []
+    regions = []
     c = Counter()
+    bytype = Counter()
+    byaccount = {}
+    # The findings index is fresher than snapshots where it is up to date
+    snapshots = getindexed(targ_regions)
+    snapshots.update(getsnapshots([r for r in targ_regions if r not in snapshots]))
+    # Query regions without a usable snapshot at once, then aggregate in
+    # declared region order
+    live = collectstats([r for r in targ_regions if r not in snapshots])
+    ages = []
     for r in targ_regions:
-        region_name = r
-        rn = get_region_name(r)['regionName']
-        response = getstats(region_name=region_name)['FindingStatistics']['CountBySeverity']
-        if response:
-            flashregion.append("<break time='.5s'/>Findings for " + str(rn) + " region")
-            for key, value in response.items():
-                sevname = getsevname(key)['SeverityName']
-                #Sum total findings across regions declared in FLASHREGIONS
-                c[key] += value
-                flashregion.append("<break time='.2s'/>" + str(value) + " " + sevname + " severity")
+        region = {"RegionId": r, "RegionName": get_region_name(r)['regionName'] or r}
+        if r in snapshots:
+            region.update(Status="ok", CountBySeverity=snapshots[r]['CountBySeverity'],
+                          CountByType=snapshots[r]['CountByType'],
+                          CountByAccount=snapshots[r]['CountByAccount'])
+            if snapshots[r]['Age'] is not None:
+                ages.append(snapshots[r]['Age'])
         else:
-            flashregion.append("<break time='.5s'/> There are no current findings in the " + str(rn) + " region.")
-
-    t = dict(c)
-    totals = t.items()
-    for key, value in totals:
-        sevname = getsevname(key)['SeverityName']
-        flashglobal.append("<break time='.2s'/>" + str(value) + " " + sevname + " severity")
-
-    # Clean up output
-    fglobal = scruboutput(inputtxt = str(flashglobal))
-    fregion = scruboutput(inputtxt = str(flashregion))
-    return fglobal, fregion
-
-# Return statistics for region
-def getstats(region_name):
-    gdclient = boto3.client('guardduty', region_name=region_name)
-    detector_id = getdetectorid(region_name)
-    if detector_id:
-        response = gdclient.get_findings_statistics(
+            region.update(live[r])
+        #Sum total findings across regions declared in FLASHREGIONS
+        c.update(region['CountBySeverity'])
+        bytype.update(region['CountByType'])
+        for account, counts in region['CountByAccount'].items():
+            byaccount.setdefault(account, Counter()).update(counts)
+        region['Summary'] = statssummary(region['CountBySeverity'], region['CountByType'])
+        regions.append(region)
+
+    accounts = [{"AccountId": a, "AccountName": getaccountname(a), "CountBySeverity": dict(byaccount[a]),
+                 "Summary": statssummary(byaccount[a])}
+                for a in getmemberaccounts() if a in byaccount]
+    # Age in seconds of the oldest snapshot used, None if all regions were live
+    brief = {"Totals": dict(c), "Summary": statssummary(c, bytype), "Regions": regions, "Accounts": accounts,
+             "SnapshotAge": max(ages) if ages else None}
+    with span('render'):
+        brief.update(renderflashbrief(brief))
+    return brief
+
+# Query COUNT_BY_SEVERITY for regions, in every member account when
+# ACCOUNTMODE is set, and merge the results per region:
+#   Status:          ok if any account answered, not_enabled if GuardDuty
+#                    is not enabled, else timeout or error
+#   CountBySeverity: severity -> count summed across accounts
+#   CountByType:     finding type -> count summed across accounts
+#   CountByAccount:  account -> severity -> count, empty without ACCOUNTMODE
+def collectstats(regions, timeout=REGIONTIMEOUT):
+    accounts = getmemberaccounts() or [None]
+    jobs = [(r, a) for r in regions for a in accounts]
+    merged = dict((r, {"Status": None, "CountBySeverity": Counter(), "CountByType": Counter(),
+                       "CountByAccount": {}}) for r in regions)
+    for (r, account), stats, error in fanout(lambda job: getstats(region_name=job[0], account=job[1]), jobs, timeout):
+        region = merged[r]
+        if error is not None:
+            print("collectstats region=" + r + " account=" + str(account) + " error=" + repr(error))
+            if region['Status'] is None:
+                region['Status'] = "timeout" if error == 'timeout' or isinstance(error, RegionUnavailable) else "error"
+            continue
+        if not stats:
+            # GuardDuty is not enabled for the region
+            if region['Status'] is None:
+                region['Status'] = "not_enabled"
+            continue
+        region['Status'] = "ok"
+        counts = stats['FindingStatistics']['CountBySeverity']
+        region['CountBySeverity'].update(counts)
+        region['CountByType'].update(findingtypes(stats))
+        if account is not None:
+            region['CountByAccount'][account] = counts
+    for region in merged.values():
+        region['CountBySeverity'] = dict(region['CountBySeverity'])
+        region['CountByType'] = dict(region['CountByType'])
+    return merged
+
+# Render speech for a flash briefing. Regions and accounts with the most
+# findings are packed in first, and failed regions are always mentioned.
+def renderflashbrief(brief):
+    flashglobal = renderbands(brief['Summary']['Bands'])
+    flashtypes = rendertypes(brief['Summary']['Types'])
+    blocks = []
+    values = []
+    problems = []
+    for region in brief['Regions']:
+        rn = region['RegionName']
+        if region['Status'] != "ok":
+            problems.append(regionproblem(region))
+            blocks.append(problems[-1])
+        elif region['Summary']['Total']:
+            blocks.append(Speech("<break time='.5s'/>Findings for " + str(rn) + " region, ").join(renderbands(region['Summary']['Bands'])))
+        else:
+            blocks.append(Speech("<break time='.5s'/> There are no current findings in the " + str(rn) + " region."))
+        values.append(float('inf') if region['Status'] != "ok" else region['Summary']['Total'])
+
+    if ACCOUNTMODE and not brief['Accounts'] and any(region['Status'] == "ok" for region in brief['Regions']):
+        blocks.append(Speech("<break time='.5s'/>The breakdown by account is not available right now."))
+        values.append(float('inf'))
+    firstaccount = len(blocks)
+    for account in brief['Accounts']:
+        block = Speech("<break time='.5s'/>Findings for " + account['AccountName'] + ", ")
+        if not account['Summary']['Total']:
+            block.say("<break time='.2s'/>none")
+        blocks.append(block.join(renderbands(account['Summary']['Bands'])))
+        values.append(account['Summary']['Total'])
+
+    chosen = pack(blocks, values, Speech().join(flashglobal).join(flashtypes))
+    flashregion = [blocks[i] for i in chosen]
+    regionsleft = len(brief['Regions']) - len([i for i in chosen if i < len(brief['Regions'])])
+    accountsleft = len(brief['Accounts']) - len([i for i in chosen if i >= firstaccount])
+    if regionsleft:
+        flashregion.append(Speech(moreitems(regionsleft, "regions")))
+    if accountsleft:
+        flashregion.append(Speech(moreitems(accountsleft, "accounts")))
+
+    return {"GlobalSpeech": flashglobal,
+            "TypeSpeech": flashtypes,
+            "RegionSpeech": flashregion,
+            "ProblemSpeech": problems,
+            "AgeSSML": snapshotage(brief['SnapshotAge'])}
+
+# Return Speech for a region that did not answer or has GuardDuty disabled
+def regionproblem(region):
+    rn = str(region['RegionName'])
+    if region['Status'] == "timeout":
+        return Speech("<break time='.5s'/>" + rn + " did not respond in time.")
+    if region['Status'] == "not_enabled":
+        return Speech("<break time='.5s'/>GuardDuty is not enabled in the " + rn + " region.")
+    return Speech("<break time='.5s'/>There was a problem retrieving findings for the " + rn + " region.")
+
+# Finding types returned per region by a grouped statistics call
+STATSGROUPS = 25
+
+# Cleared when GuardDuty or the bundled botocore does not accept GroupBy
+_GROUPBY = [True]
+
+# Return statistics for region, for a single member account if given. Counts
+# by finding type come back in the same call, grouped by GuardDuty, where
+# GroupBy is supported. It takes a single grouping, so resource types are not
+# included.
+def getstats(region_name, account=None):
+    criteria = findingcriteria(0)
+    if account and ACCOUNTMODE == "administrator":
+        # The administrator detector sees member findings, filter by account
+        criteria['Criterion']['accountId'] = {'Eq': [account]}
+        account = None
+
+    def statistics(detector_id, **grouping):
+        return gdcall(region_name, 'get_findings_statistics',
+            account=account,
             DetectorId=detector_id,
-            FindingCriteria={
-                'Criterion': {
-                    'service.archived': {
-                            'Eq':
-                            ['false'],
-                        },
-                    'severity': {
-                            'Gte':
-                                0,
-                        }
-                    }
-                },
+            FindingCriteria=criteria,
                 FindingStatisticTypes=[
                     'COUNT_BY_SEVERITY',
-                ]
-            )
-    else:
-        response = []
-    return response
+                ],
+            **grouping)
 
-# Return findings with minimum severity
-def listfindings(minsev, region_name):
-    gdclient = boto3.client('guardduty', region_name=region_name)
-    detector_id = getdetectorid(region_name)
-    if detector_id:
-        response = gdclient.list_findings(
-            DetectorId=detector_id,
-            FindingCriteria={
-                'Criterion': {
-                    'service.archived': {
-                            'Eq':
-                            ['false'],
-                        },
-                    'severity': {
-                            'Gte':
-                                int(minsev),
-                        }
-                    }
+    def grouped(detector_id):
+        if not (_GROUPBY and STATSTYPES):
+            return statistics(detector_id)
+        try:
+            return statistics(detector_id, GroupBy='FINDING_TYPE', OrderBy='DESC', MaxResults=STATSGROUPS)
+        except Exception as e:
+            if type(e).__name__ != 'ParamValidationError' and errorcode(e) != 'BadRequestException':
+                raise
+            # A stale detector Id fails here too and is left to withdetector()
+            response = statistics(detector_id)
+            print("getstats region=" + region_name + " GroupBy not supported: " + repr(e))
+            del _GROUPBY[:]
+            return response
+
+    return withdetector(region_name, grouped, account)
+
+# Member accounts as discovered in administrator mode, as (accounts, expires)
+_MEMBERS = []
+
+# Return member account Ids to aggregate, [] unless ACCOUNTMODE is set. If
+# administrator mode cannot discover members, the last members discovered
+# are used, or [] for totals from the administrator detector without a
+# breakdown by account, for DETECTORNEGTTL seconds.
+def getmemberaccounts():
+    if not ACCOUNTMODE:
+        return []
+    if MEMBERACCOUNTS:
+        return [a.split(":")[0] for a in MEMBERACCOUNTS.split(",")]
+    if ACCOUNTMODE != "administrator":
+        raise ValueError("MEMBERACCOUNTS is required for ACCOUNTMODE " + ACCOUNTMODE)
+    if _MEMBERS and _MEMBERS[0][1] > time.time():
+        return _MEMBERS[0][0]
+    try:
+        return discovermembers()
+    except Exception as e:
+        print("getmemberaccounts error=" + repr(e))
+        accounts = _MEMBERS[0][0] if _MEMBERS else []
+        _MEMBERS[:] = [(accounts, time.time() + DETECTORNEGTTL)]
+        return accounts
+
+# Return this account and its associated GuardDuty members, and cache them
+def discovermembers():
+    accounts = [stscall('get_caller_identity')['Account']]
+    region_name = FLASHREGIONS.split(",")[0]
+
+    def listmembers(detector_id):
+        kwargs = {'DetectorId': detector_id, 'OnlyAssociated': 'true'}
+        while True:
+            response = gdcall(region_name, 'list_members', **kwargs)
+            accounts.extend(m['AccountId'] for m in response['Members'])
+            if not response.get('NextToken'):
+                return accounts
+            kwargs['NextToken'] = response['NextToken']
+
+    withdetector(region_name, listmembers)
+    _MEMBERS[:] = [(accounts, time.time() + DETECTORTTL)]
+    return accounts
+
+# Return spoken name for account from MEMBERACCOUNTS, or its last digits
+def getaccountname(account):
+    for a in MEMBERACCOUNTS.split(","):
+        account_id, _, name = a.partition(":")
+        if account_id == account and name:
+            return name
+    return "account ending in <say-as interpret-as='digits'>" + account[-4:] + "</say-as>"
+
+# get_findings accepts at most 50 finding Ids per call
+GETFINDINGSBATCH = 50
+
+# The parts of a finding that responses use. Full get_findings documents run to
+# several KB each and are dropped as soon as they are projected.
+Finding = namedtuple('Finding', ('Id', 'Region', 'AccountId', 'Severity', 'Type', 'Title', 'Count',
+                                 'ResourceType', 'ResourceId', 'UpdatedAt'))
+
+# Return the Finding record for a get_findings document from region
+def projectfinding(f, region_name):
+    resource = f.get('Resource', {})
+    return Finding(
+        Id=f['Id'],
+        Region=f.get('Region', region_name),
+        AccountId=f.get('AccountId'),
+        Severity=float(f['Severity']),
+        Type=f.get('Type', ''),
+        Title=f['Title'],
+        Count=f.get('Service', {}).get('Count', 1),
+        ResourceType=resource.get('ResourceType', ''),
+        ResourceId=resourceid(resource),
+        UpdatedAt=f.get('UpdatedAt'))
+
+# Return the Id of the resource a finding is about, None if it has none
+def resourceid(resource):
+    if 'InstanceDetails' in resource:
+        return resource['InstanceDetails'].get('InstanceId')
+    if 'AccessKeyDetails' in resource:
+        return resource['AccessKeyDetails'].get('AccessKeyId')
+    if resource.get('S3BucketDetails'):
+        return resource['S3BucketDetails'][0].get('Name')
+    if 'EksClusterDetails' in resource:
+        return resource['EksClusterDetails'].get('Name')
+    return None
+
+# Return criteria for unarchived findings with minimum severity
+def findingcriteria(minsev):
+    return {
+        'Criterion': {
+            'service.archived': {
+                    'Eq':
+                    ['false'],
                 },
-            MaxResults=int(MAXRESP),
-            SortCriteria={
-                'AttributeName': 'severity',
-                'OrderBy': 'ASC'
+            'severity': {
+                    'Gte':
+                        int(minsev),
+                }
             }
-            )
-    else:
-        response = []
-    return response
-
-# Return finding details
-def getfindings(minsev, region_name):
-    gdclient = boto3.client('guardduty', region_name=region_name)
-    detector_id = getdetectorid(region_name)
-    if detector_id:
-        gresponse = listfindings(minsev, region_name)
-        response = gdclient.get_findings(
-        DetectorId=detector_id,
-        FindingIds=gresponse['FindingIds'],
-        SortCriteria={
+        }
+
+# Yield Ids of findings with minimum severity, following NextToken page by page.
+# Findings come most severe first unless order is 'ASC'.
+def iterfindingids(minsev, region_name, detector_id, pagesize=GETFINDINGSBATCH, order='DESC'):
+    kwargs = {
+        'DetectorId': detector_id,
+        'FindingCriteria': findingcriteria(minsev),
+        'MaxResults': min(int(pagesize), GETFINDINGSBATCH),
+        'SortCriteria': {
             'AttributeName': 'severity',
-            'OrderBy': 'ASC'
+            'OrderBy': order
+        }
+    }
+    while True:
+        response = gdcall(region_name, 'list_findings', **kwargs)
+        for finding_id in response['FindingIds']:
+            yield finding_id
+        if not response.get('NextToken'):
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+# Yield Finding records of findings with minimum severity. Ids are paged in and
+# sent to get_findings in batches, so callers can stop as soon as they have
+# enough. Each document is released as soon as it has been projected, so at
+# most one batch is held in memory.
+def iterfindings(minsev, region_name, pagesize=GETFINDINGSBATCH, order='DESC'):
+    detector_id = getdetectorid(region_name)
+    if not detector_id:
+        return
+    ids = iterfindingids(minsev, region_name, detector_id, pagesize, order)
+    try:
+        while True:
+            batch = list(islice(ids, min(int(pagesize), GETFINDINGSBATCH)))
+            if not batch:
+                return
+            response = gdcall(region_name, 'get_findings',
+                DetectorId=detector_id,
+                FindingIds=batch,
+                SortCriteria={
+                    'AttributeName': 'severity',
+                    'OrderBy': order
+                }
+            )
+            findings = response.pop('Findings')
+            del response
+            findings.reverse()
+            while findings:
+                yield projectfinding(findings.pop(), region_name)
+    except Exception as e:
+        # Next lookup gets a fresh detector Id
+        if errorcode(e) in DETECTORERRORS:
+            invalidatedetector(region_name)
+        raise
+
+# Return a page of at least FINDINGSCAN most severe findings, starting at
+# token, as {'Findings': [Finding], 'DetectorId': ..., 'Token': token,
+# 'NextToken': ...}, or [] if GuardDuty is not enabled. Pages end on a
+# list_findings page boundary so NextToken picks up exactly where they stop.
+def readpage(minsev, region_name, token, detector_id=None):
+    scan = max(int(MAXRESP), FINDINGSCAN)
+
+    def read(detector_id):
+        kwargs = {
+            'DetectorId': detector_id,
+            'FindingCriteria': findingcriteria(minsev),
+            'MaxResults': min(scan, GETFINDINGSBATCH),
+            'SortCriteria': {
+                'AttributeName': 'severity',
+                'OrderBy': 'DESC'
             }
-        )
-    else:
-        response = []
-    return response
+        }
+        if token:
+            kwargs['NextToken'] = token
+        ids = []
+        while True:
+            response = gdcall(region_name, 'list_findings', **kwargs)
+            ids.extend(response['FindingIds'])
+            kwargs['NextToken'] = response.get('NextToken')
+            if len(ids) >= scan or not kwargs['NextToken']:
+                break
+        findings = []
+        for i in range(0, len(ids), GETFINDINGSBATCH):
+            batch = gdcall(region_name, 'get_findings', DetectorId=detector_id, FindingIds=ids[i:i + GETFINDINGSBATCH],
+                           SortCriteria={'AttributeName': 'severity', 'OrderBy': 'DESC'})['Findings']
+            findings.extend(projectfinding(f, region_name) for f in batch)
+        return {'Findings': findings, 'DetectorId': detector_id, 'Token': token, 'NextToken': kwargs['NextToken']}
 
+    if detector_id:
+        # The session cursor carries the detector Id, skip the lookup
+        try:
+            return read(detector_id)
+        except Exception as e:
+            if errorcode(e) not in DETECTORERRORS:
+                raise
+            invalidatedetector(region_name)
+    return withdetector(region_name, read)
+
+# Return the key findings are grouped by: their type, or the redacted title
+# for findings without one
+def findingkey(f):
+    return f.Type or scrub(f.Title)
+
+# Return a short hash of a group's key, for cursors in session attributes
+def groupkey(g):
+    return format(zlib.crc32(findingkey(g.First).encode('utf-8')) & 0xffffffff, '08x')
+
+# Findings of one type collapsed into a single entry:
+#   Severity:  highest severity in the group
+#   Count:     Service.Count summed over the group
+#   Findings:  number of findings in the group
+#   Resources: number of distinct resources involved
+#   First:     the group's first finding, for groups of one
+FindingGroup = namedtuple('FindingGroup', ('Type', 'Title', 'Severity', 'Count', 'Findings', 'Resources',
+                                           'ResourceType', 'First'))
+
+# Return findings grouped by findingkey() in a single pass. Groups keep the order in which
+# their first finding arrived, so most severe first findings give most severe
+# first groups.
+def groupfindings(findings):
+    index = OrderedDict()
+    for f in findings:
+        key = findingkey(f)
+        group = index.get(key)
+        if group is None:
+            index[key] = group = {'First': f, 'Severity': f.Severity, 'Count': 0, 'Findings': 0,
+                                  'Resources': set(), 'ResourceTypes': set()}
+        group['Severity'] = max(group['Severity'], f.Severity)
+        group['Count'] += f.Count
+        group['Findings'] += 1
+        group['Resources'].add(f.ResourceId or f.Id)
+        group['ResourceTypes'].add(f.ResourceType)
+    return [FindingGroup(Type=g['First'].Type, Title=g['First'].Title, Severity=g['Severity'], Count=g['Count'],
+                         Findings=g['Findings'], Resources=len(g['Resources']),
+                         ResourceType=g['ResourceTypes'].pop() if len(g['ResourceTypes']) == 1 else None,
+                         First=g['First'])
+            for g in index.values()]
+
+# Return the n most severe findings across regions, and the regions that did
+# not respond in time. Each region is read from the findings index if it is
+# up to date, otherwise from GuardDuty most severe first, stopping after n
+# findings; a bounded heap then keeps the overall top n.
+def topfindings(minsev, regions, n):
+    def regiontop(r):
+        indexed = indexfindings(minsev, r, n)
+        return indexed if indexed is not None else list(islice(iterfindings(minsev, r, n), n))
+
+    results = fanout(regiontop, regions)
+    missing = []
+    candidates = []
+    for r, findings, error in results:
+        if error is not None:
+            print("topfindings region=" + r + " error=" + repr(error))
+            missing.append(r)
+        else:
+            candidates.append(findings)
+    worst = heapq.nlargest(n, (f for findings in candidates for f in findings),
+                           key=lambda f: f.Severity)
+    return worst, missing
+
+# --------------- Tracing -----------------------------------------------------
+
+# Spans and tags of the invocation in progress. Worker threads run with the
+# trace of the invocation that started them, set by withtrace(), so
+# stragglers cannot leak into the next invocation's log line.
+_TRACE = [None]
+_THREADTRACE = threading.local()
+_COLDSTART = [True]
+
+# Return the trace spans are recorded in: the worker's own if it has one,
+# otherwise the invocation in progress
+def currenttrace():
+    return getattr(_THREADTRACE, 'trace', _TRACE[0])
+
+# Run func(*args) recording spans and tags into trace, for worker threads
+def withtrace(trace, func, *args):
+    _THREADTRACE.trace = trace
+    try:
+        return func(*args)
+    finally:
+        del _THREADTRACE.trace
+
+@contextmanager
+def span(name, **attrs):
+    """ Time a block and record it in the current invocation's trace """
+    trace = currenttrace()
+    start = time.time()
+    try:
+        yield
+    finally:
+        if trace is not None:
+            attrs['name'] = name
+            attrs['ms'] = round((time.time() - start) * 1000, 1)
+            trace['spans'].append(attrs)
+
+# Add fields to the current invocation's timing log line
+def tag(**fields):
+    trace = currenttrace()
+    if trace is not None:
+        trace.update(fields)
+
+@contextmanager
+def invocation(event):
+    """ Trace one invocation and log its timings as a single JSON line """
+    trace = {'coldStart': bool(_COLDSTART), 'spans': []}
+    del _COLDSTART[:]
+    request = event.get('request', {})
+    if request:
+        trace['requestType'] = request.get('type')
+    _TRACE[0] = trace
+    profiler = None
+    if PROFILE or event.get('profile'):
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.time()
+    try:
+        with span('dispatch'):
+            yield trace
+    finally:
+        trace['ms'] = round((time.time() - start) * 1000, 1)
+        _TRACE[0] = None
+        _DEADLINE[0] = None
+        if profiler is not None:
+            profiler.disable()
+            printprofile(profiler)
+        print(json.dumps(trace, default=str))
+
+# Log the top functions of a profile by cumulative time
+def printprofile(profiler):
+    import io
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+    print(out.getvalue())
+
+# --------------- Retries and circuit breakers --------------------------------
+
+# Error codes worth retrying. Throttling also slows down later retries to the
+# same region.
+THROTTLECODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling', 'RequestLimitExceeded')
+RETRYCODES = THROTTLECODES + ('InternalServerErrorException', 'InternalServerError',
+                              'ServiceUnavailable', 'ServiceUnavailableException')
+
+# botocore exceptions raised when an endpoint cannot be reached or does not answer
+TRANSPORTERRORS = ('EndpointConnectionError', 'ConnectTimeoutError', 'ReadTimeoutError', 'ConnectionClosedError')
+
+# Do not start a retry with less than this many seconds of budget left
+RETRYMINLEFT = 0.25
+
+# Cap on a single backoff sleep in seconds
+RETRYCAP = 2.0
+
+class RegionUnavailable(Exception):
+    """ A region was skipped because its circuit is open or the response
+    budget ran out """
+
+class CircuitBreaker(object):
+    """ Consecutive failures and throttling of one region, kept across warm
+    invocations """
+
+    __slots__ = ('failures', 'opened', 'probing', 'throttled', 'lock')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def allow(self, region_name):
+        """ Raise RegionUnavailable unless a call to the region may go ahead.
+        Once the cooldown has passed a single call probes the region. """
+        with self.lock:
+            if self.opened is None:
+                return
+            if self.probing or time.time() - self.opened < BREAKERCOOLDOWN:
+                raise RegionUnavailable(region_name + " skipped after " + str(self.failures) + " failed calls")
+            self.probing = True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+            self.throttled = max(0, self.throttled - 1)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= BREAKERTHRESHOLD:
+                self.opened = time.time()
+
+    def release(self):
+        """ End a probe that neither succeeded nor failed, e.g. because the
+        response budget ran out, so a later call can probe again """
+        with self.lock:
+            self.probing = False
+
+    def backoff(self, attempt, throttled):
+        """ Seconds to sleep before the next attempt. Backoff grows with the
+        attempt and with how often the region has throttled lately. """
+        with self.lock:
+            if throttled:
+                self.throttled = min(self.throttled + 1, 4)
+            ceiling = RETRYBASE * 2 ** (attempt + self.throttled)
+        return random.uniform(0, min(ceiling, RETRYCAP))
+
+# Circuit breakers by region
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+# Wall clock time the current invocation's GuardDuty calls must finish by
+_DEADLINE = [None]
+
+# Start the response budget from the Lambda context, capped at budget_ms
+def setdeadline(context, budget_ms=None):
+    budgets = [budget_ms] if budget_ms else []
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        # Leave time to log and return
+        budgets.append(context.get_remaining_time_in_millis() - 500)
+    _DEADLINE[0] = time.time() + min(budgets) / 1000.0 if budgets else None
+
+# Return seconds left in the response budget, None if there is no deadline
+def remaining():
+    deadline = _DEADLINE[0]
+    return None if deadline is None else deadline - time.time()
+
+# Return timeout capped at the seconds left in the response budget. A timeout
+# of None waits as long as the budget allows, e.g. scheduled refreshes.
+def budgeted(timeout):
+    left = remaining()
+    if left is None:
+        return timeout
+    return max(0, left if timeout is None else min(timeout, left))
+
+# Return call() for a single region, giving up with RegionUnavailable when
+# the response budget runs out first. A call blocked on a slow endpoint is
+# left to finish in the background, like fanout() stragglers, so the voice
+# response does not wait for the read timeout.
+def withinbudget(region_name, call):
+    (_, result, error), = fanout(lambda r: call(), [region_name], timeout=None)
+    if error == 'timeout':
+        raise RegionUnavailable(region_name + " skipped, response budget spent")
+    if error is not None:
+        raise error
+    return result
+
+# Return the circuit breaker for region
+def getbreaker(region_name):
+    breaker = _BREAKERS.get(region_name)
+    if breaker is None:
+        with _BREAKERS_LOCK:
+            breaker = _BREAKERS.setdefault(region_name, CircuitBreaker())
+    return breaker
+
+# Return whether error is throttling, a server side failure or a network error
+def retryable(error):
+    return errorcode(error) in RETRYCODES or type(error).__name__ in TRANSPORTERRORS
+
+# Return call(attempt) for region, retrying throttled and failed calls with
+# jittered backoff while attempts and the response budget last. Regions with an
+# open circuit fail fast with RegionUnavailable.
+def retrying(region_name, call):
+    breaker = getbreaker(region_name)
+    budgetspent = RegionUnavailable(region_name + " skipped, response budget spent")
+    left = remaining()
+    if left is not None and left <= 0:
+        # Before allow(), so an out of budget call does not take the probe
+        raise budgetspent
+    breaker.allow(region_name)
+    try:
+        attempt = 0
+        while True:
+            left = remaining()
+            if left is not None and left <= 0:
+                raise budgetspent
+            try:
+                result = call(attempt)
+            except Exception as e:
+                if not retryable(e):
+                    # The region answered, the request itself was wrong
+                    breaker.success()
+                    raise
+                delay = breaker.backoff(attempt, errorcode(e) in THROTTLECODES)
+                left = remaining()
+                if attempt + 1 >= RETRYATTEMPTS or (left is not None and delay + RETRYMINLEFT > left):
+                    breaker.failure()
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            breaker.success()
+            return result
+    finally:
+        # A probe that ended any other way must not hold the circuit open
+        breaker.release()
+
+# --------------- Response cache ----------------------------------------------
+
+class ResponseCache(object):
+    """ LRU cache of rendered responses with a per entry TTL and a memory cap.
+    Lives across warm invocations. Hits and misses go to the timing log.
+    """
+    def __init__(self, ttl, maxbytes):
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                self.discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            tag(responseCache="hit" if entry else "miss", responseCacheHits=self.hits,
+                responseCacheMisses=self.misses)
+            return entry[0] if entry else None
+
+    def put(self, key, response):
+        if self.ttl <= 0:
+            return
+        size = len(json.dumps(response))
+        with self.lock:
+            self.discard(key)
+            if size > self.maxbytes:
+                return
+            self.entries[key] = (response, time.time() + self.ttl, size)
+            self.size += size
+            # Evict least recently used until under the memory cap
+            while self.size > self.maxbytes:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+RESPONSES = ResponseCache(RESPONSECACHETTL, RESPONSECACHEBYTES)
+
+# Return True if the user asked for fresh data, e.g. "get fresh statistics"
+def wantsrefresh(intent):
+    return bool(intent.get('slots', {}).get('Refresh', {}).get('value'))
+
+# --------------- Finding continuation ----------------------------------------
+
+# A finding details answer leaves a cursor in the session attributes so "next
+# findings" can pick up where it stopped:
+#   Region, MinSev, DetectorId: the question being continued
+#   Token:    list_findings token of the page being spoken, None for the first
+#   NextToken: token of the page after it, None after the last page
+#   Spoken:   groupkey() of every group spoken so far, oldest first
+#   More:     whether anything is left to speak
+# Alexa limits the whole response to 24 KB, so at most CURSORSPOKEN keys of
+# 8 characters are kept. Older ones are dropped and may be spoken again.
+CURSORSPOKEN = 200
+
+# Pages read or prefetched for cursors, by (region, minsev, token), as
+# (expires, future). Pages are shared between sessions asking the same thing.
+PAGETTL = 120
+PAGESKEPT = 16
+_PAGES = OrderedDict()
+_PAGES_LOCK = threading.Lock()
+_PREFETCHER = []
+
+# Pages of findings a next findings request reads at most, looking for types
+# not spoken yet
+NEXTPAGES = 3
+
+# Return a cursor at the start of the first page
+def newcursor(region_name, minsev, page):
+    return {'Region': region_name, 'MinSev': minsev, 'DetectorId': page['DetectorId'],
+            'Token': None, 'NextToken': page['NextToken'], 'Spoken': [], 'More': False}
+
+# Return cursor moved past groups just spoken from page, and prefetch the page
+# the next request will need
+def advancecursor(cursor, page, groups):
+    spoken = (cursor['Spoken'] + [groupkey(g) for g in groups])[-CURSORSPOKEN:]
+    seen = set(spoken)
+    unspoken = any(groupkey(g) not in seen for g in groupfindings(page['Findings']))
+    cursor = dict(cursor, Token=page['Token'], NextToken=page['NextToken'], Spoken=spoken,
+                  More=bool(unspoken or page['NextToken']))
+    keeppage(cursor['Region'], cursor['MinSev'], page)
+    if not unspoken and page['NextToken']:
+        prefetch(cursor['Region'], cursor['MinSev'], page['NextToken'], cursor['DetectorId'])
+    return cursor
+
+# Return the page cursor continues on and the next MAXRESP unspoken groups.
+# Moves on to following pages, up to NEXTPAGES, while a page has nothing left
+# to speak.
+def nextgroups(cursor):
+    seen = set(cursor['Spoken'])
+    token = cursor['Token']
+    for _ in range(NEXTPAGES):
+        page = getpage(cursor['MinSev'], cursor['Region'], token, cursor['DetectorId'])
+        if not page:
+            return None, []
+        groups = [g for g in groupfindings(page['Findings']) if groupkey(g) not in seen]
+        if groups or not page['NextToken']:
+            return page, groups[:int(MAXRESP)]
+        token = page['NextToken']
+    return page, []
+
+# Return the page at token, prefetched if available, otherwise read now
+def getpage(minsev, region_name, token, detector_id=None):
+    key = (region_name, str(minsev), token)
+    with _PAGES_LOCK:
+        entry = _PAGES.pop(key, None)
+    if entry is not None and entry[0] > time.time():
+        try:
+            page = entry[1].result(timeout=remaining())
+            tag(prefetched=True)
+            return page
+        except Exception as e:
+            print("getpage region=" + region_name + " prefetch error=" + repr(e))
+    return readpage(minsev, region_name, token, detector_id)
+
+# Keep a page that has been read for the next request of the same cursor
+def keeppage(region_name, minsev, page):
+    from concurrent.futures import Future
+    future = Future()
+    future.set_result(page)
+    storepage((region_name, str(minsev), page['Token']), future)
+
+# Start reading the page at token in the background, so it is ready when the
+# user asks for more. Lambda freezes the container once the response is
+# returned, so a read that has not finished by then resumes on the next
+# invocation.
+def prefetch(region_name, minsev, token, detector_id):
+    key = (region_name, str(minsev), token)
+    if key in _PAGES:
+        return
+    if not _PREFETCHER:
+        from concurrent.futures import ThreadPoolExecutor
+        _PREFETCHER.append(ThreadPoolExecutor(max_workers=2))
+    storepage(key, _PREFETCHER[0].submit(withtrace, currenttrace(), readpage, minsev, region_name, token, detector_id))
+
+# Store a page future, evicting the oldest pages beyond PAGESKEPT
+def storepage(key, future):
+    with _PAGES_LOCK:
+        _PAGES.pop(key, None)
+        _PAGES[key] = (time.time() + PAGETTL, future)
+        while len(_PAGES) > PAGESKEPT:
+            _PAGES.popitem(last=False)
+
+# --------------- Statistics snapshots ----------------------------------------
+
+# In-process snapshot table with the subset of the DynamoDB Table interface
+# used here. Also the local stand-in for DynamoDB in tests.
+class MemoryTable(object):
+    def __init__(self, key='SnapshotId'):
+        self.key = key
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def put_item(self, Item):
+        with self.lock:
+            self.items[Item[self.key]] = dict(Item)
+        return {}
+
+    def get_item(self, Key):
+        with self.lock:
+            item = self.items.get(Key[self.key])
+        return {'Item': dict(item)} if item else {}
+
+# Snapshot table persisted to a JSON file
+class FileTable(MemoryTable):
+    def __init__(self, path, key='SnapshotId'):
+        MemoryTable.__init__(self, key)
+        self.path = path
+        try:
+            with open(path) as f:
+                self.items = json.load(f)
+        except (IOError, ValueError):
+            self.items = {}
+
+    def put_item(self, Item):
+        MemoryTable.put_item(self, Item)
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.items, f)
+            os.rename(tmp, self.path)
+        return {}
+
+_SNAPSHOTTABLE = []
+
+# Return the table configured in SNAPSHOTSTORE, or None if snapshots are off
+def getsnapshottable():
+    if not SNAPSHOTSTORE:
+        return None
+    if not _SNAPSHOTTABLE:
+        kind, _, name = SNAPSHOTSTORE.partition(":")
+        if kind == "memory":
+            table = MemoryTable()
+        elif kind == "file":
+            table = FileTable(name)
+        elif kind == "dynamodb":
+            import boto3
+            table = boto3.resource('dynamodb').Table(name)
+        else:
+            raise ValueError("Invalid SNAPSHOTSTORE " + SNAPSHOTSTORE)
+        _SNAPSHOTTABLE.append(table)
+    return _SNAPSHOTTABLE[0]
+
+# Query regions and store their COUNT_BY_SEVERITY statistics
+def refreshsnapshots(regions):
+    table = getsnapshottable()
+    if table is None:
+        raise ValueError("SNAPSHOTSTORE is not configured")
+    refreshed = []
+    failed = []
+    disabled = []
+    # Not on the voice path, so wait for slow regions
+    stats = collectstats(regions, timeout=None)
+    for r in regions:
+        if stats[r]['Status'] == "not_enabled":
+            # Not stored, so the briefing keeps saying so
+            disabled.append(r)
+            continue
+        if stats[r]['Status'] != "ok":
+            failed.append(r)
+            continue
+        table.put_item(Item={
+            'SnapshotId': "stats#" + r,
+            'RegionId': r,
+            'CountBySeverity': stats[r]['CountBySeverity'],
+            'CountByType': stats[r]['CountByType'],
+            'CountByAccount': stats[r]['CountByAccount'],
+            'UpdatedAt': int(time.time())
+        })
+        refreshed.append(r)
+    return {"Refreshed": refreshed, "Failed": failed, "NotEnabled": disabled}
+
+# Return {region: {'CountBySeverity': ..., 'CountByType': ..., 'CountByAccount': ...,
+# 'Age': seconds}}
+# for regions with a snapshot younger than SNAPSHOTMAXAGE
+def getsnapshots(regions):
+    table = getsnapshottable()
+    if table is None:
+        return {}
+    now = int(time.time())
+    snapshots = {}
+    for r in regions:
+        try:
+            item = table.get_item(Key={'SnapshotId': "stats#" + r}).get('Item')
+        except Exception as e:
+            print("getsnapshots region=" + r + " error=" + repr(e))
+            continue
+        if item and now - int(item['UpdatedAt']) <= SNAPSHOTMAXAGE:
+            # DynamoDB returns numbers as Decimal
+            counts = dict((k, int(v)) for k, v in item['CountBySeverity'].items())
+            bytype = dict((k, int(v)) for k, v in item.get('CountByType', {}).items())
+            byaccount = dict((a, dict((k, int(v)) for k, v in c.items()))
+                             for a, c in item.get('CountByAccount', {}).items())
+            snapshots[r] = {'CountBySeverity': counts, 'CountByType': bytype, 'CountByAccount': byaccount,
+                            'Age': now - int(item['UpdatedAt'])}
+    return snapshots
+
+# Return SSML telling how old snapshot statistics are
+def snapshotage(age):
+    if age is None:
+        return ""
+    minutes = int(age) // 60
+    if minutes < 1:
+        return " <break time='.3s'/>These statistics are less than a minute old."
+    return " <break time='.3s'/>These statistics are " + str(minutes) + (" minute" if minutes == 1 else " minutes") + " old."
+
+# --------------- Delta briefings --------------------------------------------
+
+_LOCALTABLE = []
+
+# Return the table for per-user state: the snapshot table if configured,
+# otherwise a table that only lives as long as the container
+def getstatetable():
+    table = getsnapshottable()
+    if table is None:
+        if not _LOCALTABLE:
+            _LOCALTABLE.append(MemoryTable())
+        table = _LOCALTABLE[0]
+    return table
+
+# Return what changed for a user since their watermark and move it forward.
+# The watermark holds the newest updatedAt the user has heard about and, as
+# CheckedAt, when they last asked (both epoch milliseconds).
+#   Since:   when the user last asked in epoch milliseconds, None on the
+#            first call
+#   Brief:   full flash briefing, first call only
+#   Saved:   whether the watermark was written, on the first call only when
+#            every region answered
+#   Regions: per region RegionId, RegionName, Status and Updated, the counts
+#            of findings updated after the watermark by severity band
+#   Total:   number of findings updated after the watermark
+def getdelta(userid):
+    table = getstatetable()
+    key = "watermark#" + userid
+    mark = table.get_item(Key={'SnapshotId': key}).get('Item')
+    now = int(time.time() * 1000)
+
+    if not mark:
+        brief = getflashbrief()
+        # Regions without GuardDuty have nothing to miss
+        saved = all(region['Status'] in ("ok", "not_enabled") for region in brief['Regions'])
+        if saved:
+            table.put_item(Item={'SnapshotId': key, 'UpdatedAt': now, 'CheckedAt': now})
+        return {"Since": None, "Brief": brief, "Saved": saved, "Regions": [], "Total": 0}
+
+    since = int(mark['UpdatedAt'])
+    # Watermarks written before CheckedAt was kept
+    checked = int(mark.get('CheckedAt', since))
+    newest = since
+    regions = []
+    total = 0
+    targ_regions = FLASHREGIONS.split(",")
+    for r, updated, error in fanout(lambda r: getupdated(r, since), targ_regions):
+        region = {"RegionId": r, "RegionName": get_region_name(r)['regionName'] or r,
+                  "Status": "ok", "Updated": {}}
+        if error is not None:
+            print("getdelta region=" + r + " error=" + repr(error))
+            region['Status'] = "timeout" if error == 'timeout' else "error"
+        elif updated:
+            region['Updated'] = updated['Updated']
+            newest = max(newest, updated['Newest'])
+            total += sum(updated['Updated'].values())
+        regions.append(region)
+
+    # Regions that failed are retried from the same watermark next time
+    saved = all(region['Status'] == "ok" for region in regions)
+    if saved:
+        table.put_item(Item={'SnapshotId': key, 'UpdatedAt': newest, 'CheckedAt': now})
+    return {"Since": checked, "Brief": None, "Saved": saved, "Regions": regions, "Total": total}
+
+# Return counts by severity band of findings in region updated after since
+# (epoch milliseconds), and the newest updatedAt among them. None when nothing
+# changed or GuardDuty is not enabled.
+def getupdated(region_name, since):
+    criteria = findingcriteria(0)
+    criteria['Criterion']['updatedAt'] = {'Gt': since}
+
+    def updated(detector_id):
+        stats = gdcall(region_name, 'get_findings_statistics',
+                       DetectorId=detector_id,
+                       FindingCriteria=criteria,
+                       FindingStatisticTypes=['COUNT_BY_SEVERITY'])['FindingStatistics']['CountBySeverity']
+        if not stats:
+            return None
+        newest = gdcall(region_name, 'list_findings',
+                        DetectorId=detector_id,
+                        FindingCriteria=criteria,
+                        MaxResults=1,
+                        SortCriteria={'AttributeName': 'updatedAt', 'OrderBy': 'DESC'})['FindingIds']
+        latest = since
+        if newest:
+            finding = gdcall(region_name, 'get_findings', DetectorId=detector_id, FindingIds=newest)['Findings'][0]
+            latest = max(since, epochmillis(finding['UpdatedAt']))
+        return {"Updated": bandcounts(stats), "Newest": latest}
+
+    return withdetector(region_name, updated) or None
+
+# Return epoch milliseconds for a GuardDuty timestamp such as 2018-02-01T20:43:22.021Z
+def epochmillis(timestamp):
+    parsed = datetime.strptime(timestamp.replace("Z", ""), "%Y-%m-%dT%H:%M:%S.%f")
+    return int((parsed - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+# Return how long ago an epoch milliseconds time was, as spoken text
+def sinceago(millis):
+    minutes = max(0, int(time.time() - millis / 1000.0) // 60)
+    if minutes < 1:
+        return "less than a minute ago"
+    if minutes < 120:
+        return str(minutes) + (" minute" if minutes == 1 else " minutes") + " ago"
+    return str(minutes // 60) + " hours ago"
+
+@prebuilt
 def handle_session_end_request():
     card_title = "Session Ended"
     speech_output = ""
@@ -533,10 +2082,416 @@ def handle_session_end_request():
     return build_response(session_attributes, build_speechlet_response(
         intent['name'], speech_output, reprompt_text, should_end_session))
 
+# --------------- Findings index ----------------------------------------------
+
+# The index holds one item per finding, keyed by FindingId:
+#   RegionBand, SevRank: region and severity band, e.g. "us-east-1#High",
+#               and sevrank(), the ByRegionBand index the skill reads most
+#               severe first
+#   Type, ResourceId, UpdatedAt: the ByType and ByResource indexes, for
+#               lookups by finding type and by resource, newest first
+#   Region, AccountId, Severity, Title, Count, ResourceType, UpdatedAtText:
+#               the rest of the Finding record
+#   Seed:       when reconcileindex() last saw the finding, 0 if only an
+#               event has
+# An item "seed#<region>" records when each region was last reconciled, and
+# "events#<region>" when the region's first finding event arrived.
+FINDINGINDEXKEY = 'FindingId'
+FINDINGINDEXES = {
+    'ByRegionBand': ('RegionBand', 'SevRank'),
+    'ByType': ('Type', 'UpdatedAt'),
+    'ByResource': ('ResourceId', 'UpdatedAt')
+}
+
+# Findings read from the index for a finding details request. Next findings
+# pages through them without going back to GuardDuty.
+INDEXPAGE = 500
+
+# Key conditions SqliteTable understands: "A = :a" or "A = :a AND B > :b"
+_KEYCONDITION = re.compile(r'^(\w+) = (:\w+)(?: AND (\w+) (=|<|<=|>|>=) (:\w+))?$')
+
+# Findings index in SQLite with the DynamoDB Table interface the index uses:
+# put_item, get_item, delete_item and query on the primary key or an index.
+# Items are stored as JSON with their key and index attributes as columns.
+class SqliteTable(object):
+    def __init__(self, path, key, indexes):
+        import sqlite3
+        self.key = key
+        self.indexes = indexes
+        self.columns = [key] + sorted(set(a for pair in indexes.values() for a in pair))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS items (' + ', '.join('"' + c + '"' for c in self.columns) +
+                            ', item TEXT, PRIMARY KEY ("' + key + '"))')
+            for name, (partition, sort) in indexes.items():
+                self.db.execute('CREATE INDEX IF NOT EXISTS "' + name + '" ON items ("' + partition + '", "' + sort + '")')
+
+    def put_item(self, Item):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO items VALUES (' + ', '.join('?' * (len(self.columns) + 1)) + ')',
+                            [Item.get(c) for c in self.columns] + [json.dumps(Item)])
+        return {}
+
+    def get_item(self, Key):
+        with self.lock:
+            row = self.db.execute('SELECT item FROM items WHERE "' + self.key + '" = ?', (Key[self.key],)).fetchone()
+        return {'Item': json.loads(row[0])} if row else {}
+
+    def delete_item(self, Key):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM items WHERE "' + self.key + '" = ?', (Key[self.key],))
+        return {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, IndexName=None, ScanIndexForward=True,
+              Limit=None, Select=None, ExclusiveStartKey=None):
+        match = _KEYCONDITION.match(KeyConditionExpression.strip())
+        if match is None or match.group(1) not in self.columns or (match.group(3) and match.group(3) not in self.columns):
+            raise ValueError("Unsupported key condition " + KeyConditionExpression)
+        partition, value, sort, op, sortvalue = match.groups()
+        sql = 'SELECT item FROM items WHERE "' + partition + '" = ?'
+        args = [ExpressionAttributeValues[value]]
+        if sort:
+            sql += ' AND "' + sort + '" ' + op + ' ?'
+            args.append(ExpressionAttributeValues[sortvalue])
+        if IndexName:
+            sql += ' ORDER BY "' + self.indexes[IndexName][1] + '"' + ('' if ScanIndexForward else ' DESC')
+        if Limit:
+            sql += ' LIMIT ' + str(int(Limit))
+        with self.lock:
+            items = [json.loads(row[0]) for row in self.db.execute(sql, args)]
+        if Select == 'COUNT':
+            return {'Count': len(items)}
+        return {'Items': items, 'Count': len(items)}
+
+_FINDINGINDEX = []
+
+# Return the table configured in FINDINGINDEX, or None if the index is off
+def getfindingindex():
+    if not FINDINGINDEX:
+        return None
+    if not _FINDINGINDEX:
+        kind, _, name = FINDINGINDEX.partition(":")
+        if kind == "sqlite":
+            table = SqliteTable(name, FINDINGINDEXKEY, FINDINGINDEXES)
+        elif kind == "dynamodb":
+            import boto3
+            table = boto3.resource('dynamodb').Table(name)
+        else:
+            raise ValueError("Invalid FINDINGINDEX " + FINDINGINDEX)
+        _FINDINGINDEX.append(table)
+    return _FINDINGINDEX[0]
+
+# Return a string that sorts by severity, e.g. "08.000" for 8
+def sevrank(severity):
+    return "%06.3f" % float(severity)
+
+# Return the index item for a Finding, without empty attributes since index
+# keys cannot be empty
+def indexitem(f, seed=0):
+    updated = epochmillis(f.UpdatedAt) if f.UpdatedAt else 0
+    item = {
+        'FindingId': f.Id,
+        'RegionBand': f.Region + "#" + getsevname(str(f.Severity))['SeverityName'],
+        # Most severe, then most recently updated, first in ByRegionBand
+        'SevRank': sevrank(f.Severity) + "#" + "%013d" % updated,
+        'UpdatedAt': updated,
+        'UpdatedAtText': f.UpdatedAt,
+        'Region': f.Region,
+        'AccountId': f.AccountId,
+        # DynamoDB does not take floats
+        'Severity': str(f.Severity),
+        'Type': f.Type,
+        'Title': f.Title,
+        'Count': int(f.Count),
+        'ResourceType': f.ResourceType,
+        'ResourceId': f.ResourceId,
+        'Seed': seed
+    }
+    return dict((k, v) for k, v in item.items() if v is not None and v != '')
+
+# Return the Finding record for an index item
+def indexrecord(item):
+    return Finding(
+        Id=item['FindingId'],
+        Region=item['Region'],
+        AccountId=item.get('AccountId'),
+        Severity=float(item['Severity']),
+        Type=item.get('Type', ''),
+        Title=item['Title'],
+        Count=int(item['Count']),
+        ResourceType=item.get('ResourceType', ''),
+        ResourceId=item.get('ResourceId'),
+        UpdatedAt=item.get('UpdatedAtText'))
+
+# Return a copy of an event payload with keys capitalized as get_findings
+# returns them, e.g. instanceDetails -> InstanceDetails
+def capitalized(value):
+    if isinstance(value, dict):
+        return dict((k[:1].upper() + k[1:], capitalized(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [capitalized(v) for v in value]
+    return value
+
+# Upsert the finding in an event detail into the index, or remove it when it
+# has been archived
+def indexfinding(detail):
+    table = getfindingindex()
+    if table is None:
+        raise ValueError("FINDINGINDEX is not configured")
+    finding = capitalized(detail)
+    covered = "events#" + finding['Region']
+    if not table.get_item(Key={FINDINGINDEXKEY: covered}).get('Item'):
+        # The region has an EventBridge rule feeding the index
+        table.put_item(Item={FINDINGINDEXKEY: covered, 'FirstAt': int(time.time())})
+    if finding.get('Service', {}).get('Archived'):
+        table.delete_item(Key={FINDINGINDEXKEY: finding['Id']})
+        return {"Removed": finding['Id']}
+    item = indexitem(projectfinding(finding, finding['Region']))
+    previous = table.get_item(Key={FINDINGINDEXKEY: item['FindingId']}).get('Item')
+    if previous:
+        # Keep the finding for the next reconcile
+        item['Seed'] = previous.get('Seed', 0)
+    table.put_item(Item=item)
+    return {"Indexed": item['FindingId']}
+
+# Yield the items of a ByRegionBand partition, most severe first, stopping
+# below minsev or after limit items if given
+def iterindex(table, regionband, select=None, minsev=None, limit=None):
+    kwargs = {
+        'IndexName': 'ByRegionBand',
+        'KeyConditionExpression': "RegionBand = :rb",
+        'ExpressionAttributeValues': {':rb': regionband},
+        'ScanIndexForward': False
+    }
+    if select:
+        kwargs['Select'] = select
+    if minsev is not None:
+        kwargs['KeyConditionExpression'] += " AND SevRank >= :low"
+        kwargs['ExpressionAttributeValues'][':low'] = sevrank(minsev)
+    while limit is None or limit > 0:
+        if limit is not None:
+            kwargs['Limit'] = limit
+        response = table.query(**kwargs)
+        items = response.get('Items', [{'Count': response['Count']}] if select else [])
+        for item in items:
+            yield item
+        if limit is not None:
+            limit -= len(items)
+        if not response.get('LastEvaluatedKey'):
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+# Return the index table if region was reconciled within FINDINGINDEXMAXAGE
+# and finding events from it reach the index, else None. Events are only
+# published in the region a finding is raised in, so a region without its own
+# EventBridge rule would miss new findings until the next reconcile.
+def freshindex(region_name):
+    table = getfindingindex()
+    if table is None:
+        return None
+    seed = table.get_item(Key={FINDINGINDEXKEY: "seed#" + region_name}).get('Item')
+    if not seed or time.time() - int(seed['SeededAt']) > FINDINGINDEXMAXAGE:
+        return None
+    if not table.get_item(Key={FINDINGINDEXKEY: "events#" + region_name}).get('Item'):
+        return None
+    return table
+
+# Return up to limit Finding records with minimum severity from the index,
+# most severe first, or None if region is not indexed or the index is stale
+def indexfindings(minsev, region_name, limit):
+    table = freshindex(region_name)
+    if table is None:
+        return None
+    with span('index', region=region_name):
+        findings = []
+        for band in reversed(SEVNAMES):
+            if len(findings) >= limit:
+                break
+            if float(SEVVALUES[band.lower()]['MaxSev']) < float(minsev):
+                continue
+            findings.extend(indexrecord(i) for i in iterindex(table, region_name + "#" + band, minsev=minsev,
+                                                              limit=limit - len(findings)))
+        return findings
+
+# Return a readpage()-shaped page of findings from the index, or None
+def indexpage(minsev, region_name):
+    findings = indexfindings(minsev, region_name, max(INDEXPAGE, FINDINGSCAN))
+    if findings is None:
+        return None
+    return {'Findings': findings, 'DetectorId': None, 'Token': None, 'NextToken': None}
+
+# Return {region: {'CountBySeverity': ..., 'CountByType': {}, 'CountByAccount': {},
+# 'Age': None}} counted from the index for regions where it is up to date. The
+# index has no per account breakdown, so it is not used with ACCOUNTMODE.
+def getindexed(regions):
+    if not FINDINGINDEX or ACCOUNTMODE:
+        return {}
+
+    def counts(region_name):
+        table = freshindex(region_name)
+        if table is None:
+            return None
+        with span('index', region=region_name):
+            # Counted per band, keyed by the band's lowest severity
+            return dict((SEVVALUES[band.lower()]['MinSev'],
+                         sum(int(c['Count']) for c in iterindex(table, region_name + "#" + band, 'COUNT')))
+                        for band in SEVNAMES)
+
+    indexed = {}
+    for r, bands, error in fanout(counts, regions):
+        if error is not None:
+            print("getindexed region=" + r + " error=" + repr(error))
+        elif bands is not None:
+            indexed[r] = {'CountBySeverity': dict((k, n) for k, n in bands.items() if n),
+                          'CountByType': {}, 'CountByAccount': {}, 'Age': None}
+    return indexed
+
+# Reconcile the index with GuardDuty for regions: every unarchived finding is
+# written with a new Seed, then findings not seen that have not been updated
+# since, which were archived without an event, are removed.
+def reconcileindex(regions):
+    table = getfindingindex()
+    reconciled = []
+    failed = []
+
+    def reconcile(region_name):
+        seed = int(time.time() * 1000)
+        count = 0
+        for f in iterfindings(0, region_name):
+            table.put_item(Item=indexitem(f, seed))
+            count += 1
+        for band in SEVNAMES:
+            for item in list(iterindex(table, region_name + "#" + band)):
+                if int(item.get('Seed', 0)) != seed and int(item['UpdatedAt']) < seed:
+                    table.delete_item(Key={FINDINGINDEXKEY: item['FindingId']})
+        table.put_item(Item={FINDINGINDEXKEY: "seed#" + region_name, 'SeededAt': seed // 1000, 'Findings': count})
+        return count
+
+    # Not on the voice path, so wait for slow regions
+    for r, count, error in fanout(reconcile, regions, timeout=None):
+        if error is not None:
+            print("reconcileindex region=" + r + " error=" + repr(error))
+            failed.append(r)
+        else:
+            reconciled.append(r)
+    return {"Reconciled": reconciled, "Failed": failed}
+
 # --------------- Helpers that build all of the responses ----------------------
 
+# Redactions for text taken from findings, applied in a single pass. At each
+# position the first alternative that matches wins.
+_REDACT = re.compile(
+    r'(?P<amp>&)'
+    r'|(?P<strip>[\[\]"])'
+    r'|(?P<against>against i-\w+)'
+    r'|(?P<instance>instance i-\w+)'
+    r'|(?P<instanceid>\bi-\w{1,17}\b)'
+    r'|(?P<ip>\b[0-9]+(?:\.[0-9]+){3}\b)')
+_REDACTWITH = {
+    'amp': 'and',
+    'strip': '',
+    'against': 'against an EC2 instance',
+    'instance': 'instance',
+    'instanceid': 'EC2 instance',
+    'ip': 'IP host'
+}
+_TAGS = re.compile(r'<[^>]+>')
+
+# Redact instance Ids and IP addresses from finding text
+def scrub(text):
+    return _REDACT.sub(lambda m: _REDACTWITH[m.lastgroup], text)
+
+# Alexa rejects output speech longer than 8000 characters
+SPEECHCHARS = 8000
+
+# Characters of card text spoken per second, to estimate speaking time
+SPEECHRATE = 14.0
+
+# Room kept for the fixed prompts around packed items, as (characters, seconds)
+PACKFRAME = (600, 10.0)
+
+_BREAKS = re.compile(r"<break time='([0-9.]+)(m?s)'/>")
+
+# Return indexes, in order, of the items that fit in a response when the most
+# valuable items are taken first. reserve is other speech in the response,
+# such as totals, that has to fit as well.
+def pack(items, values, reserve=None, separator=", "):
+    chars, seconds = PACKFRAME
+    if reserve is not None:
+        size, duration = reserve.measure()
+        chars += size
+        seconds += duration
+    chosen = []
+    # Stable sort, so equal values keep their order
+    for i in sorted(range(len(items)), key=lambda i: values[i], reverse=True):
+        size, duration = items[i].measure()
+        size += len(separator)
+        if chars + size <= SPEECHCHARS and seconds + duration <= SPEECHSECONDS:
+            chosen.append(i)
+            chars += size
+            seconds += duration
+    return sorted(chosen)
+
+# Return SSML summarizing n items left out of a response, "" if there are none
+def moreitems(n, noun):
+    if not n:
+        return ""
+    return "<break time='.3s'/> and " + str(n) + " more " + noun
+
+class Speech(object):
+    """ SSML and card text for a response, built side by side so the card
+    never has to be recovered from the finished SSML.
+    """
+    __slots__ = ('ssml', 'card')
+
+    def __init__(self, markup=""):
+        self.ssml = []
+        self.card = []
+        if markup:
+            self.say(markup)
+
+    def say(self, markup):
+        """ Append trusted SSML such as prompts with breaks """
+        self.ssml.append(markup)
+        self.card.append(_TAGS.sub('', markup) if '<' in markup else markup)
+        return self
+
+    def redact(self, text):
+        """ Append text taken from a finding, redacted once as it is added """
+        text = scrub(str(text))
+        self.ssml.append(text)
+        self.card.append(text)
+        return self
+
+    def join(self, items, separator=", "):
+        """ Append other Speech items separated by separator """
+        for i, item in enumerate(items):
+            if i:
+                self.say(separator)
+            self.ssml.extend(item.ssml)
+            self.card.extend(item.card)
+        return self
+
+    def tossml(self):
+        return "".join(self.ssml)
+
+    def measure(self):
+        """ Return SSML characters and estimated seconds to speak """
+        ssml = self.tossml()
+        pauses = sum(float(t) / (1000.0 if unit == 'ms' else 1.0) for t, unit in _BREAKS.findall(ssml))
+        return len(ssml), len(self.tocard()) / SPEECHRATE + pauses
+
+    def tocard(self):
+        return "".join(self.card)
+
 def build_speechlet_response(title, output, reprompt_text, should_end_session):
-    cleanout = re.sub(r'(<([^>]+)>)', '', output)
+    with span('render'):
+        if isinstance(output, Speech):
+            cleanout = output.tocard()
+            output = output.tossml()
+        else:
+            cleanout = _TAGS.sub('', output)
     return {
         'outputSpeech': {
             'type': 'SSML',
@@ -561,8 +2516,9 @@ def build_speechlet_response(title, output, reprompt_text, should_end_session):
     }
 
 def build_response(session_attributes, speechlet_response):
-    return {
-        'version': '1.0',
-        'sessionAttributes': session_attributes,
-        'response': speechlet_response
-    }
+    with span('response'):
+        return {
+            'version': '1.0',
+            'sessionAttributes': session_attributes,
+            'response': speechlet_response
+        }
@@ -0,0 +1,79 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Regression tests for the findings index, kept in SQLite, against the
+benchmark's local GuardDuty stand-in.
+"""
+
+import unittest
+
+from test_flash_briefing import bench, loadfunction
+
+
+def findingevent(finding):
+    """ EventBridge "GuardDuty Finding" event for a stand-in finding """
+    return {
+        'source': "aws.guardduty",
+        'detail-type': "GuardDuty Finding",
+        'detail': {
+            'id': finding['Id'],
+            'region': finding['Region'],
+            'accountId': finding['AccountId'],
+            'severity': finding['Severity'],
+            'type': finding['Type'],
+            'title': finding['Title'],
+            'updatedAt': finding['UpdatedAt'],
+            'service': {'count': finding['Service']['Count'], 'archived': False},
+            'resource': {'resourceType': "Instance", 'instanceDetails': {'instanceId': "i-0000000a"}}
+        }
+    }
+
+
+class FindingsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.regions = bench.REGIONS[:2]
+        self.world = bench.World(self.regions, 200, 0, 0, 0)
+        self.module = loadfunction(self.world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions),
+                                                'FINDINGINDEX': "sqlite::memory:"})
+        self.module.lambda_handler({'source': "aws.events", 'detail-type': "Scheduled Event"}, bench.Context())
+        # Only the first region has a rule sending its finding events
+        self.module.lambda_handler(findingevent(self.world.findings[self.regions[0]][0]), bench.Context())
+        self.world.reset()
+
+    def test_regions_without_events_are_read_live(self):
+        self.module.topfindings(0, self.regions, 5)
+        self.assertEqual(self.world.regioncalls[(self.regions[0], 'ListFindings')], 0)
+        self.assertGreater(self.world.regioncalls[(self.regions[1], 'ListFindings')], 0)
+
+    def test_top_findings_read_is_bounded(self):
+        table = self.module.getfindingindex()
+        query = table.query
+        read = []
+
+        def counted(**kwargs):
+            response = query(**kwargs)
+            read.append(len(response.get('Items', [])))
+            return response
+
+        table.query = counted
+        findings = self.module.indexfindings(0, self.regions[0], 5)
+        self.assertEqual(len(findings), 5)
+        self.assertLessEqual(sum(read), 5)
+        expected = sorted((f['Severity'] for f in self.world.findings[self.regions[0]]), reverse=True)[:5]
+        self.assertEqual([f.Severity for f in findings], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Regression tests for the flash briefing against the benchmark's local
+GuardDuty stand-in.
+
+    python -m unittest discover tests
+"""
+
+import importlib
+import os
+import sys
+import unittest
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(ROOT, "benchmark"))
+
+import lambda_benchmark as bench
+
+
+def loadfunction(world, env):
+    """ Import a fresh copy of the function with every client it builds
+    routed to the local stand-in """
+    for name in ('MAXRESP', 'FLASHREGIONS', 'REGIONTIMEOUT', 'SNAPSHOTSTORE', 'RESPONSECACHETTL', 'ACCOUNTMODE', 'MEMBERACCOUNTS',
+                 'FINDINGINDEX', 'RESPONSEBUDGET'):
+        os.environ.pop(name, None)
+    os.environ.update(env)
+    sys.path.insert(0, bench.LAMBDA_DIR)
+    sys.modules.pop('lambda_function', None)
+    try:
+        module = importlib.import_module('lambda_function')
+    finally:
+        sys.path.remove(bench.LAMBDA_DIR)
+
+    def client(region_name, service='guardduty', account=None):
+        if account is None:
+            return world.client(service, region_name)
+        # Member account clients use credentials assumed through LocalSTS
+        credentials = module.getcredentials(account)
+        return world.client(service, region_name, aws_access_key_id=credentials['AccessKeyId'])
+
+    module.getclient = client
+    return module
+
+
+class FlashBriefingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.regions = bench.REGIONS
+        self.world = bench.World(self.regions, 20, 0, 0, 0)
+        self.module = loadfunction(self.world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions)})
+
+    def test_each_region_queried_once(self):
+        self.module.lambda_handler(bench.SCENARIOS['FlashBriefing'](), bench.Context())
+        for r in self.regions:
+            self.assertEqual(self.world.regioncalls[(r, 'ListDetectors')], 1, r)
+            self.assertEqual(self.world.regioncalls[(r, 'GetFindingsStatistics')], 1, r)
+        self.assertEqual(sum(self.world.calls.values()), 2 * len(self.regions))
+
+    def test_speech_card_and_reprompt_share_one_briefing(self):
+        response = self.module.lambda_handler(bench.SCENARIOS['FlashBriefing'](), bench.Context())['response']
+        self.assertIn("flash briefing", response['outputSpeech']['ssml'])
+        self.assertTrue(response['card']['text'])
+        self.assertTrue(response['reprompt']['outputSpeech']['ssml'])
+        self.assertEqual(self.world.calls['GetFindingsStatistics'], len(self.regions))
+
+
+class FindingTypeSpeechTest(unittest.TestCase):
+
+    def test_types_are_split_into_words(self):
+        module = loadfunction(bench.World(bench.REGIONS[:1], 0, 0, 0, 0), {'MAXRESP': "5", 'FLASHREGIONS': bench.REGIONS[0]})
+        spoken = {
+            "UnauthorizedAccess:EC2/SSHBruteForce": "Unauthorized Access EC2 SSH Brute Force",
+            "Recon:IAMUser/MaliciousIPCaller": "Recon IAM User Malicious IP Caller",
+            "Trojan:EC2/DNSDataExfiltration": "Trojan EC2 DNS Data Exfiltration",
+            "CryptoCurrency:EC2/BitcoinTool.B!DNS": "Crypto Currency EC2 Bitcoin Tool B DNS",
+        }
+        for t, words in spoken.items():
+            speech = module.rendertypes([{'Type': t, 'Count': 2}])[0].tossml()
+            self.assertIn(words + ", 2", speech)
+
+
+class FailedRegionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.regions = bench.REGIONS[:3]
+
+    def briefing(self, world, env=None):
+        env = dict({'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions)}, **(env or {}))
+        module = loadfunction(world, env)
+        return module.lambda_handler(bench.SCENARIOS['FlashBriefing'](), bench.Context())['response']['outputSpeech']['ssml']
+
+    def test_no_region_answering_is_not_an_all_clear(self):
+        world = bench.World(self.regions, 20, 300, 0, 0)
+        speech = self.briefing(world, {'REGIONTIMEOUT': "0.05"})
+        self.assertNotIn("no current", speech)
+        self.assertIn("could not be retrieved", speech)
+        self.assertIn("Virginia did not respond in time", speech)
+
+    def test_disabled_region_is_reported(self):
+        world = bench.World(self.regions, 0, 0, 0, 0)
+        world.disabled.add("us-east-2")
+        speech = self.briefing(world)
+        self.assertIn("GuardDuty is not enabled in the Ohio region", speech)
+        self.assertNotIn("no current findings in the Ohio region", speech)
+        self.assertIn("no current GuardDuty findings in the regions that answered", speech)
+
+
+class AccountModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.regions = bench.REGIONS[:3]
+        self.world = bench.World(self.regions, 30, 0, 0, 0, accounts=3)
+        self.expected = Counter(f['AccountId'] for r in self.regions for f in self.world.findings[r])
+
+    def briefing(self, mode, members=""):
+        module = loadfunction(self.world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions),
+                                           'ACCOUNTMODE': mode, 'MEMBERACCOUNTS': members})
+        brief = module.getflashbrief()
+        return dict((a['AccountId'], sum(a['CountBySeverity'].values())) for a in brief['Accounts'])
+
+    def test_administrator_discovers_members(self):
+        self.assertEqual(self.briefing("administrator"), dict(self.expected))
+        self.assertEqual(self.world.calls['GetCallerIdentity'], 1)
+        self.assertEqual(self.world.calls['ListMembers'], 1)
+        self.assertEqual(self.world.calls['AssumeRole'], 0)
+
+    def test_administrator_without_members_still_briefs(self):
+        self.world.denied.add('ListMembers')
+        module = loadfunction(self.world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions),
+                                           'ACCOUNTMODE': "administrator"})
+        speech = module.lambda_handler(bench.SCENARIOS['FlashBriefing'](), bench.Context())['response']['outputSpeech']['ssml']
+        self.assertIn("breakdown by account is not available", speech)
+        brief = module.getflashbrief()
+        self.assertEqual(sum(brief['Totals'].values()), sum(self.expected.values()))
+        self.assertEqual(self.world.calls['ListMembers'], 1)
+
+    def test_assumerole_reads_each_account(self):
+        self.assertEqual(self.briefing("assumerole", ",".join(self.world.accounts)), dict(self.expected))
+        self.assertEqual(self.world.calls['AssumeRole'], len(self.world.accounts))
+        self.assertEqual(self.world.calls['GetFindingsStatistics'], len(self.regions) * len(self.world.accounts))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Check that the benchmark's --importtime child measures every module the
+function imports, and none of the benchmark's own.
+"""
+
+import argparse
+import sys
+import unittest
+
+from test_flash_briefing import bench
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs Python 3.7")
+class ImportTimeTest(unittest.TestCase):
+
+    def test_cold_start_measures_the_function_imports(self):
+        args = argparse.Namespace(regions=1, findings=10, accounts=1, account_mode="")
+        env = {'MAXRESP': "5", 'FLASHREGIONS': bench.REGIONS[0]}
+        names = [name for name, depth, us in bench.coldimports(args, env, 'LaunchRequest')]
+        self.assertIn('lambda_function', names)
+        # Also imported by the benchmark, so hidden when it loads first
+        for name in ('json', 'random', 'threading', 'datetime'):
+            self.assertIn(name, names)
+        for name in ('lambda_benchmark', 'argparse', 'subprocess'):
+            self.assertNotIn(name, names)
+
+
+if __name__ == '__main__':
+    unittest.main()
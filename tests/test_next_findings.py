@@ -0,0 +1,63 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Regression tests for continuing finding details with "next findings" against
+the benchmark's local GuardDuty stand-in.
+"""
+
+import json
+import re
+import unittest
+from collections import Counter
+
+from test_flash_briefing import bench, loadfunction
+
+# Spoken form of the finding types below, as "Kind" and two letters
+KINDS = re.compile(r"Kind [A-Z][a-z]\b")
+
+
+class NextFindingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.world = bench.World(["us-west-2"], 300, 0, 0, 0)
+        self.kinds = ["Kind" + chr(ord('A') + i % 26) + chr(ord('a') + i // 26) for i in range(30)]
+        for i, f in enumerate(self.world.findings["us-west-2"]):
+            kind = self.kinds[i % len(self.kinds)]
+            f['Type'] = "Custom:EC2/" + kind
+            f['Title'] = kind[:4] + " " + kind[4:] + " on an EC2 instance"
+        self.module = loadfunction(self.world, {'MAXRESP': "5", 'FLASHREGIONS': "us-west-2"})
+
+    def ask(self, intent, slots=None, attributes=None):
+        event = bench.event(intent, slots)
+        event['session']['attributes'] = attributes or {}
+        response = self.module.lambda_handler(event, bench.Context())
+        return response['response']['outputSpeech']['ssml'], response.get('sessionAttributes') or {}
+
+    def test_walk_to_the_end_speaks_each_type_once(self):
+        speech, attributes = self.ask("ListFindings", {'selectedRegion': {'name': "selectedRegion", 'value': "Oregon"}})
+        spoken = Counter(KINDS.findall(speech))
+        for _ in range(50):
+            if 'Cursor' not in attributes:
+                break
+            self.assertLess(len(json.dumps(attributes['Cursor'])), 1024)
+            speech, attributes = self.ask("NextFindings", attributes=attributes)
+            spoken.update(KINDS.findall(speech))
+        self.assertIn("There are no more GuardDuty findings", speech)
+        self.assertGreater(self.world.calls['ListFindings'], 1)
+        self.assertEqual([k for k, n in spoken.items() if n > 1], [])
+        self.assertEqual(sorted(spoken), sorted(k[:4] + " " + k[4:] for k in self.kinds))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Check that the Lambda package the template deploys is built from the
+current source.
+"""
+
+import os
+import unittest
+import zipfile
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lambda")
+
+
+class PackageTest(unittest.TestCase):
+
+    def test_package_matches_source(self):
+        with zipfile.ZipFile(os.path.join(LAMBDA_DIR, "alexa-ask-guardduty-lambda.zip")) as package:
+            packaged = package.read("lambda_function.py")
+        with open(os.path.join(LAMBDA_DIR, "lambda_function.py"), "rb") as source:
+            self.assertEqual(packaged, source.read(),
+                             "Rebuild lambda/alexa-ask-guardduty-lambda.zip, see Deployment in README.md")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Regression tests for retries, circuit breakers and the response budget.
+"""
+
+import time
+import unittest
+
+from test_flash_briefing import bench, loadfunction
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = loadfunction(bench.World(bench.REGIONS[:1], 0, 0, 0, 0), {'MAXRESP': "5", 'FLASHREGIONS': bench.REGIONS[0]})
+        self.module.RETRYBASE = 0.001
+        self.calls = []
+
+    def failing(self, seconds=0):
+        def call(attempt):
+            self.calls.append(attempt)
+            time.sleep(seconds)
+            raise bench.ClientError("InternalServerErrorException", "ListFindings")
+        return call
+
+    def test_fanout_without_timeout_stops_at_deadline(self):
+        self.module.setdeadline(None, 200)
+        start = time.time()
+        results = self.module.fanout(lambda r: time.sleep(1), ["us-east-1"], timeout=None)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(results, [("us-east-1", None, 'timeout')])
+
+    def test_breaker_opens_then_probes_and_closes(self):
+        self.module.RETRYATTEMPTS = 1
+        self.module.BREAKERCOOLDOWN = 0.1
+        for _ in range(self.module.BREAKERTHRESHOLD):
+            self.assertRaises(bench.ClientError, self.module.retrying, "us-east-1", self.failing())
+        self.assertRaises(self.module.RegionUnavailable, self.module.retrying, "us-east-1", self.failing())
+        self.assertEqual(len(self.calls), self.module.BREAKERTHRESHOLD)
+
+        time.sleep(0.15)
+        self.assertEqual(self.module.retrying("us-east-1", lambda attempt: "probed"), "probed")
+        self.assertIsNone(self.module.getbreaker("us-east-1").opened)
+        self.assertEqual(self.module.retrying("us-east-1", lambda attempt: "closed"), "closed")
+
+    def test_no_retry_once_budget_is_spent(self):
+        self.module.setdeadline(None, 100)
+        self.assertRaises(bench.ClientError, self.module.retrying, "us-east-1", self.failing(0.15))
+        self.assertEqual(self.calls, [0])
+        self.assertRaises(self.module.RegionUnavailable, self.module.retrying, "us-east-1", self.failing())
+        self.assertEqual(self.calls, [0])
+
+
+class ResponseBudgetTest(unittest.TestCase):
+
+    def test_single_region_intents_answer_within_budget(self):
+        regions = bench.REGIONS[:1]
+        # Three sequential calls of 200 ms each for a finding details request
+        world = bench.World(regions, 20, 200, 0, 0)
+        for scenario in ('ListFindings', 'ListStats'):
+            module = loadfunction(world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(regions), 'RESPONSEBUDGET': "300"})
+            event = bench.SCENARIOS[scenario]()
+            event['request']['intent']['slots']['selectedRegion']['value'] = "Virginia"
+            start = time.time()
+            speech = module.lambda_handler(event, bench.Context())['response']['outputSpeech']['ssml']
+            self.assertLess(time.time() - start, 0.45, scenario)
+            self.assertIn("problem retrieving", speech)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+# http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""
+Regression tests for the WhatsNew intent against the benchmark's local
+GuardDuty stand-in.
+"""
+
+import time
+import unittest
+
+from test_flash_briefing import bench, loadfunction
+
+HOUR = 3600 * 1000
+
+
+class WhatsNewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.regions = bench.REGIONS[:2]
+        self.world = bench.World(self.regions, 10, 0, 0, 0)
+        self.module = loadfunction(self.world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions)})
+        # Nothing updated lately unless a test says so
+        for r in self.regions:
+            for f in self.world.findings[r]:
+                self.update(f, int(time.time() * 1000) - 240 * HOUR)
+
+    def ask(self):
+        event = bench.event("WhatsNew")
+        return self.module.lambda_handler(event, bench.Context())['response']['outputSpeech']['ssml']
+
+    def update(self, finding, millis):
+        finding['UpdatedAtMillis'] = millis
+        finding['UpdatedAt'] = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(millis / 1000.0))
+
+    def test_since_is_when_the_user_last_asked(self):
+        self.assertIn("I will remember where you left off", self.ask())
+        now = int(time.time()) * 1000
+        # A watermark hours behind the last check, as when the newest finding
+        # was updated long before the user asked
+        table = self.module.getstatetable()
+        key = "watermark#" + bench.event()['session']['user']['userId']
+        table.put_item(Item={'SnapshotId': key, 'UpdatedAt': now - 7 * HOUR, 'CheckedAt': now})
+        self.update(self.world.findings[self.regions[0]][0], now - 6 * HOUR)
+
+        speech = self.ask()
+        self.assertIn("Since you last asked less than a minute ago, 1 finding was new or updated", speech)
+        self.assertEqual(int(table.get_item(Key={'SnapshotId': key})['Item']['UpdatedAt']), now - 6 * HOUR)
+        self.assertIn("Nothing has changed since you last asked less than a minute ago", self.ask())
+
+    def test_first_call_without_every_region_is_not_an_all_clear(self):
+        world = bench.World(self.regions, 10, 300, 0, 0)
+        self.module = loadfunction(world, {'MAXRESP': "5", 'FLASHREGIONS': ",".join(self.regions),
+                                           'REGIONTIMEOUT': "0.05"})
+        speech = self.ask()
+        self.assertNotIn("no current", speech)
+        self.assertIn("Virginia did not respond in time", speech)
+        key = "watermark#" + bench.event()['session']['user']['userId']
+        self.assertNotIn('Item', self.module.getstatetable().get_item(Key={'SnapshotId': key}))
+
+
+if __name__ == '__main__':
+    unittest.main()